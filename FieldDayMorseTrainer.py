@@ -12,27 +12,35 @@ Michael.Bridak@gmail.com
 # pylint: disable=global-statement
 
 from pathlib import Path
+import argparse
+import mmap
 import os
 import subprocess
+import struct
 import sys
 import logging
+import threading
 import time
+import queue
 import random
-from math import ceil
+import functools
+import heapq
+import itertools
+import tracemalloc
+import types
+import wave
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from enum import Enum
 from json import loads, dumps
+import numpy as np
 from PyQt5.QtGui import QFontDatabase
-from PyQt5.QtCore import QDir, Qt, QRunnable, QThreadPool
+from PyQt5.QtCore import QDir, Qt
 from PyQt5 import QtCore, QtWidgets, uic, QtGui
 
 settings = None
 
-# Globals for IPC
-message = ""
-guessed_callsign = ""
-guessed_class = ""
-guessed_section = ""
-call_resolved = False
-result = ["", "", ""]
+SAMPLE_RATE = 16000
 
 settings = {
     "SIDE_TONE": 650,
@@ -44,6 +52,26 @@ settings = {
     "MY_CLASS": "1B",
     "MY_SECTION": "ORG",
     "MY_SPEED": 30,
+    "CANADIAN_CALLERS": 10,
+    "CALLSIGN_DATABASE": "",
+    "SESSION_LOG": "session.json",
+    "LOG_JOURNAL": "fdm_log.jsonl",
+    "ADAPTIVE_DIFFICULTY": False,
+    "BAND_NOISE": 0,
+    "NOISE_COLOR": "pink",
+    "QSB": 0,
+    "STATIC_CRASHES": 0,
+    "CHIRP": 0,
+    "QRM": 0,
+    "RECEIVER_FILTER": 2400,
+    "FILTER_WIDTHS": [100, 250, 500, 2400],
+    "AUDIO_BACKEND": "auto",
+    "AUDIO_PERIOD": 256,
+    "AUDIO_LATENCY": 0.064,
+    "AUDIO_FILE": "fdm_audio.wav",
+    "KEYER_MODE": "iambic",
+    "KEYER_SERIAL": "",
+    "KEYER_MIDI": "",
 }
 
 
@@ -69,7 +97,7 @@ def load_fonts_from_dir(directory):
 
 
 class CalculatePhraseTime:
-    """calulates the time to send a phrase"""
+    """the Morse code, and how long its elements and spaces last"""
 
     def __init__(self):
         self.character_timing = {
@@ -112,376 +140,3390 @@ class CalculatePhraseTime:
             " ": 7,
             "?": 15,
         }
+        self.morse_code = {
+            "A": ".-",
+            "B": "-...",
+            "C": "-.-.",
+            "D": "-..",
+            "E": ".",
+            "F": "..-.",
+            "G": "--.",
+            "H": "....",
+            "I": "..",
+            "J": ".---",
+            "K": "-.-",
+            "L": ".-..",
+            "M": "--",
+            "N": "-.",
+            "O": "---",
+            "P": ".--.",
+            "Q": "--.-",
+            "R": ".-.",
+            "S": "...",
+            "T": "-",
+            "U": "..-",
+            "V": "...-",
+            "W": ".--",
+            "X": "-..-",
+            "Y": "-.--",
+            "Z": "--..",
+            "0": "-----",
+            "1": ".----",
+            "2": "..---",
+            "3": "...--",
+            "4": "....-",
+            "5": ".....",
+            "6": "-....",
+            "7": "--...",
+            "8": "---..",
+            "9": "----.",
+            "?": "..--..",
+        }
+
+    def layout(self, phrase: str):
+        """
+        Yields each character we know how to send, with the elements of space
+        before it. Three between characters and seven between words.
+        """
+        gap = 0
+        for word in phrase.upper().split():
+            if gap:
+                gap = self.character_timing[" "]
+            for character in word:
+                if character not in self.morse_code:
+                    continue
+                yield gap, character
+                gap = 3
+
+    @staticmethod
+    def units(wpm: int, effective_wpm: int = None):
+        """
+        Returns the length in seconds of an element of sound and an element of
+        space. PARIS timing, a dit is 1.2 / wpm. With Farnsworth timing the
+        characters go at wpm and the spaces are stretched to average effective_wpm.
+        """
+        mark = 1.2 / wpm
+        if not effective_wpm or effective_wpm >= wpm:
+            return mark, mark
+        delay = (60 * wpm - 37.2 * effective_wpm) / (wpm * effective_wpm)
+        return mark, delay / 19
+
+
+class WaveformCache:
+    """
+    Least recently used cache of rendered characters, bounded by how many bytes
+    of samples it holds rather than how many entries.
+    """
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, build) -> np.ndarray:
+        """Return the cached samples for key, calling build() to make them if needed."""
+        with self.lock:
+            samples = self.entries.get(key)
+            if samples is not None:
+                self.entries.move_to_end(key)
+                instruments.count("waveform hits")
+                return samples
+            instruments.count("waveform misses")
+        samples = build()
+        samples.setflags(write=False)
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = samples
+                self.size += samples.nbytes
+                while self.size > self.max_bytes and len(self.entries) > 1:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.size -= evicted.nbytes
+                    instruments.count("waveform evictions")
+            instruments.level("waveform bytes", self.size)
+        return samples
+
+
+class MorseSynth:
+    """
+    Turns text into keyed tone samples, in process, so no 'morse' program is needed.
+    Element lengths follow the same model as CalculatePhraseTime. Characters are
+    rendered once per speed and pitch, then phrases are stitched together from the
+    cached characters.
+    """
+
+    def __init__(
+        self,
+        sample_rate: int = SAMPLE_RATE,
+        rise_time: float = 0.005,
+        cache: WaveformCache = None,
+    ):
+        self.sample_rate = sample_rate
+        self.timing = CalculatePhraseTime()
+        self.cache = cache if cache is not None else WaveformCache()
+        ramp_length = max(1, int(sample_rate * rise_time))
+        self.ramp = (0.5 - 0.5 * np.cos(np.linspace(0.0, np.pi, ramp_length))).astype(
+            np.float32
+        )
+
+    def element_length(self, wpm: int) -> int:
+        """Samples in one dit, PARIS timing."""
+        return max(1, round(self.sample_rate * self.timing.units(wpm)[0]))
+
+    def render_character(self, character: str, wpm: int, pitch: float) -> np.ndarray:
+        """
+        One character at full volume, with shaped rise and fall on every element.
+        With no pitch it's just the keying envelope.
+        """
+        element = self.element_length(wpm)
+        code = self.timing.morse_code[character]
+        envelope = np.zeros(
+            self.timing.character_timing[character] * element, dtype=np.float32
+        )
+        ramp = self.ramp[: element // 2]
+        position = 0
+        for symbol in code:
+            length = element if symbol == "." else 3 * element
+            envelope[position : position + length] = 1.0
+            envelope[position : position + len(ramp)] = ramp
+            envelope[position + length - len(ramp) : position + length] = ramp[::-1]
+            position += length + element
+        if pitch is None:
+            return envelope
+        phase = np.arange(len(envelope), dtype=np.float32) * np.float32(
+            2.0 * np.pi * pitch / self.sample_rate
+        )
+        return np.sin(phase) * envelope
+
+    def character(self, character: str, wpm: int, pitch: float) -> np.ndarray:
+        """One character at full volume, from the cache when we've sent it before."""
+        return self.cache.get(
+            (character, wpm, pitch, self.sample_rate),
+            lambda: self.render_character(character, wpm, pitch),
+        )
+
+    def render(
+        self,
+        phrase: str,
+        wpm: int,
+        pitch: float,
+        volume: float,
+        effective_wpm: int = None,
+    ) -> np.ndarray:
+        """
+        Returns the phrase as float32 samples in the range -volume..volume.
+        Elements are a whole number of samples, so it can come out a few
+        milliseconds off the exact PARIS timing at high speeds.
+        """
+        space = self.sample_rate * self.timing.units(wpm, effective_wpm)[1]
+        pieces = []
+        for gap, character in self.timing.layout(phrase):
+            if gap:
+                pieces.append(np.zeros(round(gap * space), dtype=np.float32))
+            pieces.append(self.character(character, wpm, pitch))
+        if not pieces:
+            return np.zeros(0, dtype=np.float32)
+        samples = np.concatenate(pieces)
+        samples *= np.float32(volume)
+        return samples
+
+
+class Histogram:
+    """
+    Durations in microseconds, counted HDR style: exact below 64us, then 32
+    buckets to every doubling, so within about 3% from a microsecond to over
+    an hour in one fixed table. Recording is an index and an increment with
+    no lock, the odd count lost to a race doesn't matter here.
+    """
+
+    BITS = 6
+    HALF = 1 << (BITS - 1)
+    LIMIT = (1 << 32) - 1
+
+    def __init__(self):
+        self.counts = [0] * (self.index(self.LIMIT) + 1)
+        self.count = 0
+        self.max = 0
+
+    @classmethod
+    def index(cls, value: int) -> int:
+        """The bucket value falls in."""
+        magnitude = value.bit_length() - cls.BITS
+        if magnitude <= 0:
+            return value
+        return magnitude * cls.HALF + (value >> magnitude)
+
+    @classmethod
+    def value(cls, index: int) -> int:
+        """The smallest value that falls in bucket index."""
+        if index < 2 * cls.HALF:
+            return index
+        magnitude = index // cls.HALF - 1
+        return (index - magnitude * cls.HALF) << magnitude
+
+    def record(self, seconds: float) -> None:
+        """Count one duration."""
+        value = min(max(int(seconds * 1_000_000), 0), self.LIMIT)
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent: float) -> int:
+        """The duration, in microseconds, percent of the counts are at or below."""
+        target = max(1, -(-self.count * percent // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.value(index)
+        return self.max
+
+    def summary(self) -> dict:
+        """The usual percentiles, and every bucket with something in it."""
+        return {
+            "count": self.count,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "p99.9": self.percentile(99.9),
+            "max": self.max,
+            "buckets": {
+                self.value(index): count
+                for index, count in enumerate(self.counts)
+                if count
+            },
+        }
+
+
+class Instruments:
+    """
+    Latency histograms for each stage between the operator sending something
+    and the callers answering it, by name. Every stage is timed on the wall
+    clock, even in a headless run, so they show where the time really goes.
+    """
+
+    STAGES = {
+        "operator queue": "operator action to being applied on the audio thread",
+        "operator start": "applied to the first sample of the message mixed",
+        "operator transmit": "first sample of the message to the last",
+        "caller wake": "event posted to a caller running",
+        "caller match": "event posted to a caller deciding if it's them",
+        "caller reply": "event posted to the first sample of a callers reply",
+        "partial lookup": "a keystroke in the callsign field to its matches",
+        "audio callback": "mixing one period for the sound card",
+    }
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def record(self, stage: str, seconds: float) -> None:
+        """Count one duration for stage."""
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms.setdefault(stage, Histogram())
+        histogram.record(seconds)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        """Add to a running count."""
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def level(self, name: str, value: int) -> None:
+        """Note how full something is now, and the most it's been."""
+        self.counters[name] = value
+        peak = f"{name} peak"
+        self.counters[peak] = max(value, self.counters.get(peak, 0))
+
+    def reset(self) -> None:
+        """Start counting afresh."""
+        self.histograms = {}
+        self.counters = {}
+
+    def snapshot(self) -> dict:
+        """Every stage's summary, in pipeline order."""
+        histograms = dict(self.histograms)
+        order = list(self.STAGES) + sorted(set(histograms) - set(self.STAGES))
+        return {
+            stage: histograms[stage].summary() for stage in order if stage in histograms
+        }
+
+    def table(self) -> str:
+        """The snapshot as text, microseconds."""
+        lines = [
+            f"{'stage':<18} {'count':>7} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}"
+        ]
+        for stage, summary in self.snapshot().items():
+            lines.append(
+                f"{stage:<18} {summary['count']:>7} {summary['p50']:>8} "
+                f"{summary['p90']:>8} {summary['p99']:>8} {summary['max']:>8}"
+            )
+        for name, value in sorted(dict(self.counters).items()):
+            lines.append(f"{name:<18} {value:>7}")
+        return "\n".join(lines)
+
+    def dump(self, path: str) -> None:
+        """Write the snapshot, and the counters, to path as JSON."""
+        snapshot = self.snapshot()
+        if self.counters:
+            snapshot["counters"] = dict(self.counters)
+        with open(path, "wt", encoding="utf-8") as file_descriptor:
+            file_descriptor.write(dumps(snapshot, indent=1))
+
+
+instruments = Instruments()
+
+
+class Voice:
+    """A buffer of samples queued on a channel of the mixer."""
+
+    def __init__(self, samples: np.ndarray):
+        self.samples = samples
+        self.position = 0
+        self.created = time.perf_counter()
+        self.started = None
+        self.done = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def wait(self, timeout=None) -> bool:
+        """Block until the last sample has been handed to the sound card."""
+        return self.done.wait(timeout)
+
+    def add_done_callback(self, callback) -> None:
+        """Call callback() once the voice is done, right away if it already is."""
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def finish(self) -> None:
+        """Mark the voice done, run from the audio thread."""
+        with self.lock:
+            self.done.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class RingBuffer:
+    """Fixed size sample ring, the mixer writes into it and the output reads from it."""
+
+    def __init__(self, size: int):
+        self.buffer = np.zeros(size, dtype=np.float32)
+        self.size = size
+        self.read = 0
+        self.written = 0
+
+    def available(self) -> int:
+        """Samples waiting to be read."""
+        return self.written - self.read
+
+    def push(self, samples: np.ndarray) -> None:
+        """Append samples, the caller makes sure there is room."""
+        start = self.written % self.size
+        first = min(len(samples), self.size - start)
+        self.buffer[start : start + first] = samples[:first]
+        self.buffer[: len(samples) - first] = samples[first:]
+        self.written += len(samples)
+
+    def pull(self, frames: int) -> np.ndarray:
+        """Take the oldest frames out of the ring."""
+        start = self.read % self.size
+        first = min(frames, self.size - start)
+        out = np.empty(frames, dtype=np.float32)
+        out[:first] = self.buffer[start : start + first]
+        out[first:] = self.buffer[: frames - first]
+        self.read += frames
+        return out
+
+
+class Channel:
+    """One transmitter in the pileup, a caller or the operator, with its own voice."""
+
+    def __init__(self, mixer, pitch: float, speed: int, volume: float):
+        self.mixer = mixer
+        self.pitch = pitch
+        self.speed = speed
+        self.volume = volume
+        self.propagation = None
+        self.queue = deque()
+
+    def send(self, phrase: str) -> Voice:
+        """Queue a phrase of morse on this channel. Returns right away."""
+        if self.propagation is not None and self.mixer.band is not None:
+            return self.play(self.mixer.band.key(self, phrase))
+        return self.play(
+            self.mixer.synth.render(phrase, self.speed, self.pitch, self.volume)
+        )
+
+    def play(self, samples: np.ndarray) -> Voice:
+        """Queue samples on this channel. Returns right away."""
+        voice = Voice(samples)
+        with self.mixer.lock:
+            self.queue.append(voice)
+        return voice
+
+    def mix_into(self, block: np.ndarray):
+        """
+        Add this channels next block of samples to the mix.
+        Returns the voice if it finished in this block, and where.
+        """
+        voice = self.queue[0]
+        if voice.position == 0:
+            voice.started = time.perf_counter()
+        chunk = voice.samples[voice.position : voice.position + len(block)]
+        block[: len(chunk)] += chunk
+        voice.position += len(chunk)
+        if voice.position >= len(voice.samples):
+            self.queue.popleft()
+            return voice, len(chunk)
+        return None, 0
+
+    def close(self) -> None:
+        """Leave the pileup, anything still queued is dropped."""
+        self.mixer.remove(self)
+
+
+Propagation = namedtuple("Propagation", "depth rate phase chirp drift")
+Propagation.__doc__ = """How one caller's signal gets to you: how deep, in
+0..1, and how fast, in Hz, it fades, where in the fade it starts, how far
+in Hz it chirps at each key down and how fast in Hz a second it drifts."""
+
+
+class Band:
+    """
+    Everything between the callers and your receiver. Band noise, static
+    crashes and the odd station off to one side are added to each mixed
+    period from tables made up front, so a period costs the same however
+    many callers there are. Fading, chirp and drift belong to each caller and
+    are worked into their samples, all at once, when a message is keyed.
+    Everything random comes from the session's seed.
+    """
+
+    NOISE_LENGTH = 2**18
+    CHIRP_TIME = 0.01  # seconds for a chirp to settle after key down
+    CRASH_TIME = 0.4
+
+    def __init__(self, mixer, seed: int):
+        self.sample_rate = mixer.sample_rate
+        self.synth = mixer.synth
+        self.rng = np.random.default_rng(seed)
+        self.noise_level = settings["BAND_NOISE"] / 100
+        self.qsb = settings["QSB"] / 100
+        self.chirp = settings["CHIRP"] / 100
+        self.crash_rate = settings["STATIC_CRASHES"] / 60
+        self.qrm_rate = settings["QRM"] / 60
+        self.noise = None
+        self.noise_position = 0
+        if self.noise_level:
+            self.noise = self.make_noise(settings["NOISE_COLOR"]) * self.noise_level
+            self.noise_position = int(self.rng.integers(self.NOISE_LENGTH))
+        self.crash = self.make_crash() if self.crash_rate else None
+        self.crashes = []
+        self.qrm = self.make_qrm() if self.qrm_rate else []
+        self.qrm_playing = None
+        self.qrm_position = 0
+
+    def make_noise(self, color: str) -> np.ndarray:
+        """A loop of white or pink noise, at an RMS of 1."""
+        white = self.rng.standard_normal(self.NOISE_LENGTH)
+        if color == "pink":
+            spectrum = np.fft.rfft(white)
+            frequencies = np.arange(len(spectrum), dtype=np.float64)
+            frequencies[0] = 1.0
+            white = np.fft.irfft(spectrum / np.sqrt(frequencies), self.NOISE_LENGTH)
+        return (white / np.sqrt(np.mean(white**2))).astype(np.float32)
+
+    def make_crash(self) -> np.ndarray:
+        """One burst of static, a sharp crack dying away in a few rumbles."""
+        length = int(self.CRASH_TIME * self.sample_rate)
+        seconds = np.arange(length) / self.sample_rate
+        envelope = np.exp(-seconds / 0.03)
+        for start in self.rng.uniform(0.02, self.CRASH_TIME / 2, 3):
+            after = np.clip(seconds - start, 0.0, None)
+            envelope += 0.4 * np.exp(-after / 0.02) * (seconds >= start)
+        crash = self.rng.standard_normal(length) * envelope
+        return (crash / np.max(np.abs(crash))).astype(np.float32)
+
+    def make_qrm(self) -> list:
+        """What the stations just off frequency have to say, keyed ahead of time."""
+        callsigns = CallsignGenerator(random.Random(int(self.rng.integers(2**63))))
+        messages = []
+        for _ in range(4):
+            callsign, klass, section = callsigns.next()
+            offset = self.rng.uniform(100, 600) * self.rng.choice((-1, 1))
+            pitch = settings["SIDE_TONE"] + settings["BAND_WIDTH"] / 2 * np.sign(offset)
+            pitch = float(np.clip(pitch + offset, 200, self.sample_rate / 2 - 200))
+            speed = int(self.rng.integers(18, 36))
+            volume = self.rng.uniform(0.05, 0.2)
+            for text in (f"CQ FD {callsign} {callsign}", f"TU {klass} {section}"):
+                messages.append(self.synth.render(text, speed, round(pitch), volume))
+        return messages
+
+    def propagation(self, rng: random.Random):
+        """Pick how a new caller's signal gets here, None if it gets here clean."""
+        if not self.qsb and not self.chirp:
+            return None
+        depth = self.qsb * rng.uniform(0.5, 1.0)
+        rate = rng.uniform(0.05, 0.5)
+        phase = rng.uniform(0.0, 2.0 * np.pi)
+        chirp = drift = 0.0
+        if rng.random() < self.chirp:
+            chirp = rng.uniform(20.0, 80.0)
+            drift = rng.uniform(-3.0, 3.0)
+        return Propagation(depth, rate, phase, chirp, drift)
+
+    def key(self, channel, phrase: str) -> np.ndarray:
+        """A caller's message as it sounds here, faded, chirped and drifting."""
+        propagation = channel.propagation
+        if not propagation.chirp and not propagation.drift:
+            samples = self.synth.render(
+                phrase, channel.speed, channel.pitch, channel.volume
+            )
+        else:
+            envelope = self.synth.render(phrase, channel.speed, None, channel.volume)
+            seconds = np.arange(len(envelope)) / self.sample_rate
+            keyed = envelope > 0
+            down = np.zeros(len(envelope), dtype=bool)
+            down[0] = keyed[0] if len(keyed) else False
+            down[1:] = keyed[1:] & ~keyed[:-1]
+            last_down = np.maximum.accumulate(np.where(down, seconds, 0.0))
+            frequency = (
+                channel.pitch
+                + propagation.drift * seconds
+                + propagation.chirp * np.exp(-(seconds - last_down) / self.CHIRP_TIME)
+            )
+            phase = np.cumsum(frequency) * (2.0 * np.pi / self.sample_rate)
+            samples = (envelope * np.sin(phase)).astype(np.float32)
+        if propagation.depth:
+            # The fade runs on the mixer's clock, so it carries on between messages.
+            start = channel.mixer.ring.written / self.sample_rate
+            seconds = start + np.arange(len(samples)) / self.sample_rate
+            fade = 0.5 - 0.5 * np.cos(
+                2.0 * np.pi * propagation.rate * seconds + propagation.phase
+            )
+            samples = samples * (1.0 - propagation.depth * fade).astype(np.float32)
+        return samples
+
+    def process(self, block: np.ndarray) -> None:
+        """Add the band to a mixed period."""
+        frames = len(block)
+        if self.noise is not None:
+            start = self.noise_position
+            first = min(frames, self.NOISE_LENGTH - start)
+            block[:first] += self.noise[start : start + first]
+            block[first:] += self.noise[: frames - first]
+            self.noise_position = (start + frames) % self.NOISE_LENGTH
+        if self.crash is not None:
+            if self.rng.random() < self.crash_rate * frames / self.sample_rate:
+                self.crashes.append([0, self.rng.uniform(0.2, 0.8)])
+            for crash in self.crashes:
+                chunk = self.crash[crash[0] : crash[0] + frames]
+                block[: len(chunk)] += chunk * np.float32(crash[1])
+                crash[0] += frames
+            self.crashes = [
+                crash for crash in self.crashes if crash[0] < len(self.crash)
+            ]
+        if self.qrm:
+            if self.qrm_playing is None:
+                if self.rng.random() < self.qrm_rate * frames / self.sample_rate:
+                    self.qrm_playing = self.qrm[int(self.rng.integers(len(self.qrm)))]
+                    self.qrm_position = 0
+                return
+            chunk = self.qrm_playing[self.qrm_position : self.qrm_position + frames]
+            block[: len(chunk)] += chunk
+            self.qrm_position += frames
+            if self.qrm_position >= len(self.qrm_playing):
+                self.qrm_playing = None
+
+
+class Receiver:
+    """
+    The receiver's CW filter, run over the mixed band a period at a time. It's
+    a linear phase FIR filter applied with FFTs, overlap-save. The filters for
+    every width are worked out up front, and they all share the same input
+    history, so switching is just a crossfade over one period from the old
+    filter's output to the new one, no click and no extra work to speak of.
+    """
+
+    TAPS = 1025
+
+    def __init__(self, mixer, width: int, widths=(), center: float = None):
+        self.sample_rate = mixer.sample_rate
+        self.period = mixer.period
+        self.center = center if center is not None else settings["SIDE_TONE"]
+        self.size = 1 << (self.period + self.TAPS - 2).bit_length()
+        self.history = np.zeros(self.size, dtype=np.float32)
+        self.filters = {}
+        for each in set(widths) | {width}:
+            self.filters[each] = self.design(each)
+        self.width = width
+        self.previous = None
+        self.fade = np.linspace(0.0, 1.0, self.period, dtype=np.float32)
+
+    def design(self, width: int) -> np.ndarray:
+        """The spectrum of a filter width Hz wide, centered on the side tone."""
+        low = max(self.center - width / 2, 100.0)
+        middle = low + width / 2
+        taps = np.arange(self.TAPS) - (self.TAPS - 1) / 2
+        cutoff = width / 2 / self.sample_rate
+        kernel = 2 * cutoff * np.sinc(2 * cutoff * taps) * np.blackman(self.TAPS)
+        kernel *= np.cos(2.0 * np.pi * middle / self.sample_rate * taps)
+        gain = np.abs(
+            np.sum(kernel * np.exp(-2j * np.pi * middle / self.sample_rate * taps))
+        )
+        padded = np.zeros(self.size)
+        padded[: self.TAPS] = kernel / gain
+        return np.fft.rfft(padded)
+
+    def select(self, width: int) -> None:
+        """Switch to the filter width Hz wide, from the next period."""
+        if width == self.width:
+            return
+        if width not in self.filters:
+            self.filters[width] = self.design(width)
+        self.previous = self.width
+        self.width = width
+
+    def process(self, block: np.ndarray) -> None:
+        """Filter a period of the band, in place."""
+        frames = len(block)
+        self.history[:-frames] = self.history[frames:]
+        self.history[-frames:] = block
+        spectrum = np.fft.rfft(self.history)
+        block[:] = np.fft.irfft(spectrum * self.filters[self.width], self.size)[
+            -frames:
+        ]
+        if self.previous is not None:
+            before = np.fft.irfft(spectrum * self.filters[self.previous], self.size)
+            fade = self.fade[:frames]
+            block *= fade
+            block += before[-frames:] * (1.0 - fade)
+            self.previous = None
+
+
+class Keyer:
+    """
+    Your key or paddles, keyed into the mix as side tone. Key and paddle
+    changes come in as session actions, so they land at the start of a period
+    like everything else the operator does, and the keyer works out the
+    elements from there to the sample. Iambic, with dit and dah memory, or a
+    straight key. Every key down and up goes on transitions, with its sample,
+    for the decoder.
+    """
+
+    def __init__(self, mixer, pitch: float, speed: int, volume: float = 0.3):
+        self.mixer = mixer
+        self.sample_rate = mixer.sample_rate
+        self.step = 2.0 * np.pi * pitch / self.sample_rate
+        self.volume = np.float32(volume)
+        self.element = mixer.synth.element_length(speed)
+        self.ramp = np.ones(len(mixer.synth.ramp), dtype=np.float32) / len(
+            mixer.synth.ramp
+        )
+        self.straight = False
+        self.down = False
+        self.dit = self.dah = False
+        self.dit_memory = self.dah_memory = False
+        self.keyed = False  # what the keyer is sending this very sample
+        self.remaining = 0  # samples left of the current element or space
+        self.last = ""
+        self.phase = 0.0
+        self.history = np.zeros(len(self.ramp) - 1, dtype=np.float32)
+        self.transitions = deque()
+
+    def key(self, down: bool) -> None:
+        """A straight key went down or came up."""
+        self.straight = True
+        self.down = down
+
+    def paddles(self, dit: bool, dah: bool) -> None:
+        """The paddles changed, remember a squeeze made mid element."""
+        self.straight = False
+        self.dit_memory |= dit and not self.dit
+        self.dah_memory |= dah and not self.dah
+        self.dit, self.dah = dit, dah
+
+    def next_element(self) -> int:
+        """Start the next element, or stay up, returns how long for."""
+        dit = self.dit or self.dit_memory
+        dah = self.dah or self.dah_memory
+        if dit and dah:
+            element = "-" if self.last == "." else "."
+        elif dit or dah:
+            element = "." if dit else "-"
+        else:
+            self.keyed = False
+            return 0
+        self.dit_memory = self.dah_memory = False
+        self.last = element
+        self.keyed = True
+        return self.element if element == "." else 3 * self.element
+
+    def process(self, block: np.ndarray) -> None:
+        """Key the next period of side tone into block."""
+        frames = len(block)
+        if (
+            not self.down
+            and not (self.dit or self.dah or self.dit_memory or self.dah_memory)
+            and not self.remaining
+            and not self.history.any()
+        ):
+            return
+        target = np.zeros(frames, dtype=np.float32)
+        if self.straight:
+            self.keyed = self.down
+            target[:] = self.keyed
+        else:
+            position = 0
+            while position < frames:
+                if not self.remaining:
+                    if self.keyed:  # a space after every element
+                        self.keyed = False
+                        self.remaining = self.element
+                    else:
+                        self.remaining = self.next_element()
+                        if not self.remaining:
+                            break
+                length = min(self.remaining, frames - position)
+                target[position : position + length] = self.keyed
+                self.remaining -= length
+                position += length
+        keyed = np.concatenate((self.history[-1:], target))
+        start = self.mixer.ring.written
+        for change in np.flatnonzero(np.diff(keyed)):
+            self.transitions.append((start + int(change), bool(target[change])))
+        # A straight line up and down rather than a click at each edge.
+        envelope = np.convolve(np.concatenate((self.history, target)), self.ramp)
+        envelope = envelope[len(self.history) : len(self.history) + frames]
+        self.history = np.concatenate((self.history, target))[-len(self.history) :]
+        phase = self.phase + self.step * np.arange(frames)
+        self.phase = (self.phase + self.step * frames) % (2.0 * np.pi)
+        block += self.volume * envelope * np.sin(phase).astype(np.float32)
+
+
+class CWDecoder:
+    """
+    Turns key downs and ups back into text, from their timing alone. The dit
+    length starts at your speed and follows your sending, a mark under two
+    dits is a dit, a space over two dits ends a character and over five a
+    word.
+    """
+
+    def __init__(self, sample_rate: int, speed: int):
+        self.dit = sample_rate * 1.2 / speed
+        self.characters = {
+            code: character
+            for character, code in CalculatePhraseTime().morse_code.items()
+        }
+        self.last = None
+        self.down = False
+        self.code = ""
+        self.text = ""
+
+    def feed(self, sample: int, down: bool) -> str:
+        """The key changed at sample, returns any text it finished."""
+        text = ""
+        if self.last is not None:
+            length = sample - self.last
+            if down:
+                text = self.space(length)
+            else:
+                dit = length < 2 * self.dit
+                self.code += "." if dit else "-"
+                self.dit = 0.8 * self.dit + 0.2 * (length if dit else length / 3)
+        self.last = sample
+        self.down = down
+        return text
+
+    def space(self, length: int) -> str:
+        """Key up for length samples, returns the character and word it ended."""
+        text = ""
+        if self.code and length > 2 * self.dit:
+            text = self.characters.get(self.code, "*")
+            self.code = ""
+            self.text += text
+        if self.text and length > 5 * self.dit and not self.text.endswith(" "):
+            text += " "
+            self.text += " "
+        return text
+
+    def idle(self, sample: int) -> str:
+        """Nothing's changed up to sample, returns anything that finished."""
+        if self.down or self.last is None:
+            return ""
+        return self.space(sample - self.last)
+
+    def message(self, sample: int, gap: float = 10) -> str:
+        """The whole message, once the key's been up gap dits, and start afresh."""
+        if self.down or self.last is None or sample - self.last < gap * self.dit:
+            return ""
+        self.idle(sample)
+        text, self.text, self.last = self.text.strip(), "", None
+        return text
+
+
+class KeyInput:
+    """
+    Paddles on a serial port or a MIDI device, read on their own thread and
+    handed to the session. On a serial port the dit paddle is CTS and the dah
+    DSR, over MIDI notes 1 and 2 are dit and dah and note 0 a straight key,
+    the way a Vail adapter sends them. Needs pyserial or mido.
+    """
+
+    def __init__(self, session, serial_port: str = "", midi_port: str = ""):
+        self.session = session
+        self.running = True
+        self.threads = []
+        if serial_port:
+            self.start(self.read_serial, serial_port)
+        if midi_port:
+            self.start(self.read_midi, midi_port)
+
+    def start(self, target, port: str) -> None:
+        """Read port on a thread of its own."""
+        thread = threading.Thread(target=target, args=(port,), daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def read_serial(self, port: str) -> None:
+        """Poll the paddles on a serial port's handshake lines."""
+        try:
+            import serial  # pylint: disable=import-outside-toplevel
+
+            device = serial.Serial(port)
+        except (ImportError, OSError, ValueError) as exception:
+            logging.warning("Serial key %s: %s", port, exception)
+            return
+        paddles = (False, False)
+        with device:
+            while self.running:
+                now = (device.cts, device.dsr)
+                if now != paddles:
+                    paddles = now
+                    self.session.paddles(*paddles)
+                time.sleep(0.001)
+
+    def read_midi(self, port: str) -> None:
+        """Follow the notes from a MIDI key, port is part of its name."""
+        try:
+            import mido  # pylint: disable=import-outside-toplevel
+
+            name = next(name for name in mido.get_input_names() if port in name)
+            device = mido.open_input(name)
+        except (ImportError, OSError, StopIteration) as exception:
+            logging.warning("MIDI key %s: %s", port, exception)
+            return
+        paddles = [False, False]
+        with device:
+            while self.running:
+                for message in device.iter_pending():
+                    if message.type not in ("note_on", "note_off"):
+                        continue
+                    down = message.type == "note_on" and message.velocity > 0
+                    if message.note == 0:
+                        self.session.key(down)
+                    elif message.note in (1, 2):
+                        paddles[message.note - 1] = down
+                        self.session.paddles(*paddles)
+                time.sleep(0.001)
+
+    def close(self) -> None:
+        """Stop reading."""
+        self.running = False
+        for thread in self.threads:
+            thread.join(1)
+
+
+class Mixer:
+    """
+    Sums every active channel into one ring buffer, a period at a time.
+    The audio output pulls from it with a single callback, so however many
+    callers are in the pileup there is just one stream to the sound card.
+    """
+
+    def __init__(
+        self, sample_rate: int = SAMPLE_RATE, period: int = 256, capacity: int = None
+    ):
+        self.sample_rate = sample_rate
+        self.period = period
+        self.synth = MorseSynth(sample_rate)
+        self.channels = []
+        self.lock = threading.Lock()
+        # Room for a few periods, whatever AUDIO_PERIOD is set to.
+        self.ring = RingBuffer(capacity or max(8192, 4 * period))
+        self.block = np.zeros(period, dtype=np.float32)
+        self.pending = []
+        self.band = None
+        self.receiver = None
+        self.sidetone = None
+        self.keyer = None
+        self.local = np.zeros(period, dtype=np.float32)
+
+    def channel(self, pitch: float, speed: int, volume: float) -> Channel:
+        """Add a transmitter to the mix."""
+        channel = Channel(self, pitch, speed, volume)
+        with self.lock:
+            self.channels.append(channel)
+        return channel
+
+    def remove(self, channel: Channel) -> None:
+        """Take a transmitter out of the mix, releasing anyone waiting on it."""
+        with self.lock:
+            if channel in self.channels:
+                self.channels.remove(channel)
+            voices = list(channel.queue)
+            channel.queue.clear()
+        for voice in voices:
+            voice.finish()
+
+    def mix_period(self) -> None:
+        """Render the next period of every busy channel into the ring."""
+        block = self.block
+        block.fill(0.0)
+        local = self.local
+        local.fill(0.0)
+        with self.lock:
+            for channel in self.channels:
+                if channel.queue:
+                    voice, offset = channel.mix_into(
+                        local if channel is self.sidetone else block
+                    )
+                    if voice is not None:
+                        self.pending.append((self.ring.written + offset, voice))
+        if self.band is not None:
+            self.band.process(block)
+        if self.receiver is not None:
+            self.receiver.process(block)
+        if self.keyer is not None:
+            self.keyer.process(local)
+        # Your own sidetone doesn't go through the receiver.
+        block += local
+        np.clip(block, -1.0, 1.0, out=block)
+        self.ring.push(block)
+
+    def time(self) -> float:
+        """Seconds of audio handed to the output so far, the clock of an offline run."""
+        return self.ring.read / self.sample_rate
+
+    def callback(self, frames: int) -> np.ndarray:
+        """Hands the audio output its next frames, called from the output thread only."""
+        while self.ring.available() < frames:
+            self.mix_period()
+        out = self.ring.pull(frames)
+        if self.pending:
+            played = self.ring.read
+            finished = [voice for end, voice in self.pending if end <= played]
+            self.pending = [item for item in self.pending if item[0] > played]
+            for voice in finished:
+                voice.finish()
+        return out
+
+    def release(self) -> None:
+        """Wake everyone waiting on a voice, used when shutting down."""
+        with self.lock:
+            voices = [voice for channel in self.channels for voice in channel.queue]
+            voices += [voice for _, voice in self.pending]
+            for channel in self.channels:
+                channel.queue.clear()
+            self.pending = []
+        for voice in voices:
+            voice.finish()
+
+
+class AudioOutput:
+    """
+    One long lived audio stream fed from the mixer, or whatever stands in for it.
+    Where it goes is up to "AUDIO_BACKEND": PortAudio, if the sounddevice
+    module is installed, PulseAudio by way of 'pacat', ALSA by way of 'aplay',
+    a WAV file, or nowhere, and "auto" tries them in that order. PortAudio
+    pulls each period from the mixer in its own callback, the others are fed
+    by a thread that keeps "AUDIO_LATENCY" seconds queued ahead of the sound
+    card. Either way the time each period takes to mix, underruns and how
+    much is queued go in the instruments.
+    """
+
+    BACKENDS = ("portaudio", "pulse", "alsa", "wav", "null")
+
+    def __init__(self, mixer: Mixer, backend: str = None, latency: float = None):
+        self.mixer = mixer
+        self.sample_rate = mixer.sample_rate
+        self.period = mixer.period
+        latency = latency if latency is not None else settings["AUDIO_LATENCY"]
+        self.lead = max(latency, self.period / self.sample_rate)
+        self.running = True
+        self.stream = None
+        self.player = None
+        self.thread = None
+        backend = backend or settings["AUDIO_BACKEND"]
+        tried = self.BACKENDS[:3] if backend == "auto" else (backend,)
+        self.backend = next((name for name in tried if self.open(name)), "null")
+        if self.backend == "null" and backend != "null":
+            logging.warning("No audio output, tried %s", ", ".join(tried))
+        if self.stream is None:
+            self.thread = threading.Thread(target=self.pump, name="audio", daemon=True)
+            self.thread.start()
+
+    def open(self, backend: str) -> bool:
+        """Open backend, False if it isn't there."""
+        rate = str(self.sample_rate)
+        period = self.period / self.sample_rate
+        try:
+            if backend == "portaudio":
+                return self.open_portaudio()
+            if backend == "pulse":
+                self.player = AudioPipe(
+                    [
+                        "pacat",
+                        "--playback",
+                        "--raw",
+                        "--format=s16le",
+                        "--channels=1",
+                        f"--rate={rate}",
+                        f"--latency-msec={round(self.lead * 1000)}",
+                        f"--process-time-msec={round(period * 1000)}",
+                    ]
+                )
+            elif backend == "alsa":
+                self.player = AudioPipe(
+                    [
+                        "aplay",
+                        "-q",
+                        "-t",
+                        "raw",
+                        "-f",
+                        "S16_LE",
+                        "-c",
+                        "1",
+                        "-r",
+                        rate,
+                        "-B",
+                        str(int(self.lead * 2_000_000)),
+                        "-F",
+                        str(int(period * 1_000_000)),
+                    ]
+                )
+            elif backend == "wav":
+                self.player = SessionAudio(settings["AUDIO_FILE"], self.sample_rate)
+            elif backend != "null":
+                raise ValueError(f"unknown audio backend {backend}")
+        except (OSError, ValueError) as exception:
+            logging.warning("Audio backend %s: %s", backend, exception)
+            return False
+        return True
+
+    def open_portaudio(self) -> bool:
+        """Start a PortAudio stream that pulls from the mixer itself."""
+        try:
+            import sounddevice  # pylint: disable=import-outside-toplevel
+        except (ImportError, OSError) as exception:
+            logging.info("No PortAudio: %s", exception)
+            return False
+
+        def callback(outdata, frames, timing, status):
+            if status.output_underflow:
+                instruments.count("audio underruns")
+            outdata[:] = (self.fill(frames) * 32767).astype("<i2").tobytes()
+            queued = timing.outputBufferDacTime - timing.currentTime
+            instruments.level("audio queue", max(0, round(queued * self.sample_rate)))
+
+        try:
+            self.stream = sounddevice.RawOutputStream(
+                samplerate=self.sample_rate,
+                blocksize=self.period,
+                channels=1,
+                dtype="int16",
+                latency=self.lead,
+                callback=callback,
+            )
+            self.stream.start()
+        except sounddevice.PortAudioError as exception:
+            logging.warning("PortAudio: %s", exception)
+            self.stream = None
+            return False
+        return True
+
+    def fill(self, frames: int) -> np.ndarray:
+        """The next frames from the mixer, timed."""
+        started = time.perf_counter()
+        block = self.mixer.callback(frames)
+        instruments.record("audio callback", time.perf_counter() - started)
+        return block
+
+    def pump(self):
+        """Feed the stream in real time, silence included, so it never underruns."""
+        started = time.monotonic()
+        written = 0
+        while self.running:
+            block = self.fill(self.period)
+            if self.player is not None:
+                try:
+                    self.player.write(block)
+                except (BrokenPipeError, OSError) as exception:
+                    logging.warning("Audio output closed: %s", exception)
+                    self.player = None
+            written += self.period
+            ahead = written / self.sample_rate - (time.monotonic() - started)
+            if ahead < 0:
+                # The sound card ran dry waiting on us, count it and carry on from now.
+                instruments.count("audio underruns")
+                started = time.monotonic()
+                written = 0
+                ahead = 0.0
+            instruments.level("audio queue", round(ahead * self.sample_rate))
+            if ahead > self.lead:
+                time.sleep(ahead - self.lead)
+
+    def close(self):
+        """Stop the pump and the player."""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(1)
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+        self.mixer.release()
+        if self.player is not None:
+            self.player.close()
+            self.player = None
+
+
+class AudioPipe:
+    """A player program, 'aplay' or 'pacat', fed raw 16 bit PCM on its stdin."""
+
+    STARTUP = 0.2  # seconds a player that can't reach the sound card takes to quit
+
+    def __init__(self, command: list):
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        try:
+            status = self.process.wait(self.STARTUP)
+        except subprocess.TimeoutExpired:
+            return  # still running, so it's playing
+        raise OSError(f"{command[0]} exited with status {status}")
+
+    def write(self, block: np.ndarray) -> None:
+        """Queue a block for the sound card."""
+        self.process.stdin.write((block * 32767).astype("<i2").tobytes())
+        self.process.stdin.flush()
+
+    def close(self) -> None:
+        """Let it play out what it has, then stop it."""
+        try:
+            self.process.stdin.close()
+            self.process.wait(1)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+
+class SessionAudio:
+    """
+    Where a rendered session's audio goes, a WAV file, or Opus by way of
+    'opusenc', which is a fraction of the size for a long session.
+    """
+
+    def __init__(self, path: str, sample_rate: int = SAMPLE_RATE):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.encoder = None
+        self.wav = None
+        if Path(path).suffix.lower() == ".opus":
+            self.encoder = self.open_encoder()
+            if self.encoder is None:
+                self.path = os.fspath(Path(path).with_suffix(".wav"))
+                logging.warning("Writing %s instead", self.path)
+        if self.encoder is None:
+            self.wav = wave.open(self.path, "wb")
+            self.wav.setnchannels(1)
+            self.wav.setsampwidth(2)
+            self.wav.setframerate(sample_rate)
+
+    def open_encoder(self):
+        """Start 'opusenc' reading raw PCM, None if it isn't installed."""
+        try:
+            return subprocess.Popen(
+                [
+                    "opusenc",
+                    "--quiet",
+                    "--raw",
+                    "--raw-bits",
+                    "16",
+                    "--raw-rate",
+                    str(self.sample_rate),
+                    "--raw-chan",
+                    "1",
+                    "-",
+                    self.path,
+                ],
+                stdin=subprocess.PIPE,
+            )
+        except OSError as exception:
+            logging.warning("No Opus encoder: %s", exception)
+            return None
+
+    def write(self, block: np.ndarray) -> None:
+        """Add a block of the mix."""
+        pcm = (block * 32767).astype("<i2").tobytes()
+        if self.encoder is not None:
+            self.encoder.stdin.write(pcm)
+        else:
+            self.wav.writeframes(pcm)
+
+    def close(self) -> None:
+        """Finish the file."""
+        if self.encoder is not None:
+            self.encoder.stdin.close()
+            self.encoder.wait()
+            self.encoder = None
+        if self.wav is not None:
+            self.wav.close()
+            self.wav = None
+
+
+class SessionPlayer:
+    """
+    Plays a rendered session back by standing in for the Mixer in front of
+    an AudioOutput. It only streams the file, there's no synthesis at all.
+    """
+
+    def __init__(self, path: str, period: int = 256):
+        self.path = path
+        self.period = period
+        self.timeline = {}
+        timeline_path = Path(path).with_suffix(".json")
+        if timeline_path.exists():
+            with open(timeline_path, "rt", encoding="utf-8") as file_descriptor:
+                self.timeline = loads(file_descriptor.read())
+        self.sample_rate = self.timeline.get("sample_rate", SAMPLE_RATE)
+        self.decoder = None
+        self.wav = None
+        if Path(path).suffix.lower() == ".opus":
+            try:
+                self.decoder = subprocess.Popen(
+                    [
+                        "opusdec",
+                        "--quiet",
+                        "--rate",
+                        str(self.sample_rate),
+                        path,
+                        "-",
+                    ],
+                    stdout=subprocess.PIPE,
+                )
+            except OSError as exception:
+                raise OSError(f"no Opus decoder, 'opusdec': {exception}") from exception
+        else:
+            self.wav = wave.open(path, "rb")
+            if self.wav.getnchannels() != 1 or self.wav.getsampwidth() != 2:
+                raise ValueError(f"{path} is not 16 bit mono")
+            self.sample_rate = self.wav.getframerate()
+        self.finished = threading.Event()
+
+    def read(self, frames: int) -> bytes:
+        """The next frames of the file as 16 bit PCM, short at the end."""
+        if self.decoder is not None:
+            data = self.decoder.stdout.read(frames * 2)
+            return data[: len(data) // 2 * 2]
+        return self.wav.readframes(frames)
+
+    def callback(self, frames: int) -> np.ndarray:
+        """Hands the audio output its next frames, silence once the file's done."""
+        block = np.zeros(frames, dtype=np.float32)
+        if not self.finished.is_set():
+            samples = np.frombuffer(self.read(frames), dtype="<i2")
+            block[: len(samples)] = samples / 32767
+            if len(samples) < frames:
+                self.finished.set()
+        return block
+
+    def release(self) -> None:
+        """Close the file, called by the audio output when it's done with us."""
+        self.finished.set()
+        if self.decoder is not None:
+            self.decoder.stdout.close()
+            self.decoder.kill()
+            self.decoder.wait()
+            self.decoder = None
+        if self.wav is not None:
+            self.wav.close()
+            self.wav = None
+
+
+class CallsignIndex:
+    """
+    Real callsigns, with their class and section when we know them, kept in a
+    sorted file of fixed size records. The file is memory mapped rather than
+    read in, so opening a few hundred thousand calls costs next to nothing.
+    """
+
+    MAGIC = b"FDMTIDX1"
+    HEADER = struct.Struct("<8sI")
+    RECORD = struct.Struct("12s4s4s")
+    CALL_WIDTH = 12
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file_descriptor:
+            self.map = mmap.mmap(file_descriptor.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not a callsign index")
+
+    @classmethod
+    def from_settings(cls):
+        """The callsign index named in the settings, if there is one."""
+        path = settings["CALLSIGN_DATABASE"]
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            return cls(path)
+        except (OSError, ValueError) as exception:
+            logging.warning("Callsign database %s: %s", path, exception)
+            return None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int):
+        """(callsign, class, section), class and section are "" if unknown."""
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        fields = self.RECORD.unpack_from(
+            self.map, self.HEADER.size + index * self.RECORD.size
+        )
+        return tuple(field.decode("ascii").rstrip() for field in fields)
+
+    def key(self, index: int) -> bytes:
+        """The callsign of record index, still space padded."""
+        offset = self.HEADER.size + index * self.RECORD.size
+        return self.map[offset : offset + self.CALL_WIDTH]
+
+    def bisect(self, key: bytes) -> int:
+        """Index of the first record whose callsign is not less than key."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, callsign: str):
+        """The record for callsign, None if it's not in the index."""
+        key = callsign.upper().encode("ascii").ljust(self.CALL_WIDTH)
+        index = self.bisect(key)
+        if index < self.count and self.key(index) == key:
+            return self[index]
+        return None
+
+    def prefix(self, start: str, limit: int = 20) -> list:
+        """Callsigns starting with start, in order."""
+        key = start.upper().encode("ascii")
+        found = []
+        index = self.bisect(key)
+        while index < self.count and len(found) < limit:
+            callsign = self.key(index)
+            if not callsign.startswith(key):
+                break
+            found.append(callsign.decode("ascii").rstrip())
+            index += 1
+        return found
+
+    def partial(self, fragment: str, limit: int = 20) -> list:
+        """Callsigns with fragment anywhere in them, the super check partial."""
+        found = []
+        if not fragment.isascii():
+            return found  # no call has anything else in it
+        needle = fragment.upper().encode("ascii")
+        if not needle or len(needle) > self.CALL_WIDTH:
+            return found
+        position = self.map.find(needle, self.HEADER.size)
+        while position != -1 and len(found) < limit:
+            index, offset = divmod(position - self.HEADER.size, self.RECORD.size)
+            if index >= self.count:
+                break
+            if offset + len(needle) <= self.CALL_WIDTH:
+                found.append(self.key(index).decode("ascii").rstrip())
+                position = self.HEADER.size + (index + 1) * self.RECORD.size
+            else:
+                position += 1
+            position = self.map.find(needle, position)
+        return found
+
+    def sample(self, rng: random.Random):
+        """A random record."""
+        return self[rng.randrange(self.count)]
+
+    def close(self) -> None:
+        """Unmap the file."""
+        self.map.close()
+
+    @staticmethod
+    def read_source(path: str):
+        """
+        Yields (callsign, class, section) from a super check partial file, one
+        call per line, or from the QSO: lines of a Field Day Cabrillo log, where
+        both ends of every contact are used.
+        """
+        with open(path, "rt", encoding="utf-8", errors="replace") as file_descriptor:
+            for line in file_descriptor:
+                fields = line.upper().split()
+                if not fields or fields[0].startswith(("#", "//")):
+                    continue
+                if fields[0] == "QSO:":
+                    if len(fields) >= 11:
+                        yield tuple(fields[5:8])
+                        yield tuple(fields[8:11])
+                elif not fields[0].endswith(":") and not fields[0].startswith("END"):
+                    yield fields[0], "", ""
+
+    @classmethod
+    def build(cls, sources, path: str) -> int:
+        """Import sources into a new index at path, returns how many calls it holds."""
+        stations = {}
+        for source in sources:
+            for callsign, klass, section in cls.read_source(source):
+                if (
+                    not 2 < len(callsign) <= cls.CALL_WIDTH
+                    or not callsign.replace("/", "").isalnum()
+                    or not callsign.isascii()
+                ):
+                    continue
+                if (
+                    len(klass) > 4
+                    or len(section) > 4
+                    or not (klass + section).isascii()
+                ):
+                    klass, section = "", ""
+                if klass or callsign not in stations:
+                    stations[callsign] = (klass, section)
+        temporary = f"{path}.tmp"
+        with open(temporary, "wb") as file_descriptor:
+            file_descriptor.write(cls.HEADER.pack(cls.MAGIC, len(stations)))
+            for callsign in sorted(stations):
+                klass, section = stations[callsign]
+                file_descriptor.write(
+                    cls.RECORD.pack(
+                        callsign.encode("ascii").ljust(cls.CALL_WIDTH),
+                        klass.encode("ascii").ljust(4),
+                        section.encode("ascii").ljust(4),
+                    )
+                )
+        os.replace(temporary, path)
+        return len(stations)
+
+
+class PartialIndex:
+    """
+    Super check partial and dupe checking for the callsign field. Calls
+    worked this session are kept by every two and three character piece of
+    them. The callsign database, if there is one, gets the same treatment in
+    numpy arrays, sorted by piece, built on a worker thread at start up, so
+    a lookup only ever looks at calls sharing the rarest piece of what's
+    been typed. Until that's ready it falls back to CallsignIndex.partial().
+    """
+
+    SIZES = (2, 3)
+    ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789/"
+    LETTERS = set(ALPHABET)
+
+    def __init__(self, database: CallsignIndex = None):
+        self.database = database
+        self.worked = set()
+        self.worked_pieces = {}
+        self.postings = {}
+        self.characters = None
+        self.codes = np.zeros(256, dtype=np.int64)
+        for code, character in enumerate(self.ALPHABET, 1):
+            self.codes[ord(character)] = code
+        if database is not None:
+            threading.Thread(target=self.build, name="partial", daemon=True).start()
+
+    @classmethod
+    def pieces(cls, text: str, size: int) -> set:
+        """Every size long piece of text."""
+        return {text[i : i + size] for i in range(len(text) - size + 1)}
+
+    def code(self, piece: str) -> int:
+        """A piece as a number, the same way build() numbers them."""
+        code = 0
+        for character in piece:
+            code = code * (len(self.ALPHABET) + 1) + int(self.codes[ord(character)])
+        return code
+
+    def build(self) -> None:
+        """Index every piece of every call in the database."""
+        database = self.database
+        width = CallsignIndex.CALL_WIDTH
+        records = np.frombuffer(
+            database.map,
+            dtype=np.uint8,
+            count=database.count * database.RECORD.size,
+            offset=database.HEADER.size,
+        ).reshape(database.count, database.RECORD.size)
+        characters = self.codes[records[:, :width]].astype(np.int8)
+        self.characters = characters
+        base = len(self.ALPHABET) + 1
+        for size in self.SIZES:
+            codes = np.zeros((database.count, width - size + 1), dtype=np.int64)
+            valid = np.ones(codes.shape, dtype=bool)
+            for offset in range(size):
+                column = characters[:, offset : offset + codes.shape[1]]
+                codes = codes * base + column
+                valid &= column > 0
+            rows = np.broadcast_to(
+                np.arange(database.count, dtype=np.int32)[:, None], codes.shape
+            )[valid]
+            codes = codes[valid]
+            order = np.argsort(codes, kind="stable")
+            starts = np.searchsorted(codes[order], np.arange(base**size + 1))
+            self.postings[size] = (starts, rows[order])
+
+    def add_worked(self, callsign: str) -> None:
+        """Remember a call that's been logged."""
+        if not callsign or callsign in self.worked:
+            return
+        self.worked.add(callsign)
+        for size in self.SIZES:
+            for piece in self.pieces(callsign, size):
+                self.worked_pieces.setdefault(piece, set()).add(callsign)
+
+    def is_dupe(self, callsign: str) -> bool:
+        """Has this call been worked already."""
+        return callsign in self.worked
+
+    def lookup(self, fragment: str, limit: int = 20) -> tuple:
+        """Worked calls, then database calls, containing fragment."""
+        fragment = fragment.upper()
+        if len(fragment) < min(self.SIZES) or not set(fragment) <= self.LETTERS:
+            return [], []
+        size = min(len(fragment), max(self.SIZES))
+        pieces = self.pieces(fragment, size)
+        candidates = set.intersection(
+            *(self.worked_pieces.get(piece, set()) for piece in pieces)
+        )
+        worked = sorted(call for call in candidates if fragment in call)[:limit]
+        return worked, self.lookup_database(fragment, pieces, size, limit)
+
+    def lookup_database(self, fragment: str, pieces: set, size: int, limit: int):
+        """Database calls containing fragment."""
+        if self.database is None:
+            return []
+        postings = self.postings.get(size)
+        if postings is None:
+            return self.database.partial(fragment, limit)
+        starts, rows = postings
+        # Only the rarest piece's calls can hold the whole fragment.
+        codes = [self.code(piece) for piece in pieces]
+        code = min(codes, key=lambda code: starts[code + 1] - starts[code])
+        candidates = rows[starts[code] : starts[code + 1]]
+        if len(fragment) > size:
+            wanted = self.codes[np.frombuffer(fragment.encode("ascii"), np.uint8)]
+            calls = self.characters[candidates]
+            windows = calls.shape[1] - len(fragment) + 1
+            found = np.zeros(len(candidates), dtype=bool)
+            for offset in range(max(windows, 0)):
+                found |= (calls[:, offset : offset + len(fragment)] == wanted).all(1)
+            candidates = candidates[found]
+        # A call with the same piece in it twice is in the list twice, together.
+        candidates = candidates[: limit * 4]
+        if len(candidates):
+            candidates = candidates[np.r_[True, candidates[1:] != candidates[:-1]]]
+        return [
+            self.database.key(row).decode("ascii").rstrip()
+            for row in candidates[:limit].tolist()
+        ]
+
+
+class CallsignGenerator:
+    """
+    Makes up Field Day stations, (callsign, class, section), in batches ahead
+    of time. The tables are built once, calls in a batch are unique, and no call
+    is handed out twice while it's still in the pileup.
+    """
+
+    LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    CALL_AREAS = {
+        "0": "CO MO IA ND KS NE MN SD",
+        "1": "CT RI EMA VT ME WMA NH",
+        "2": "ENY NNY NLI SNJ NNJ WNY",
+        "3": "DE MDC EPA WPA",
+        "4": "AL SC GA SFL KY TN NC VA NFL VI PR WCF",
+        "5": "AR NTX LA OK MS STX NM WTX",
+        "6": "EBA SCV LAX SDG ORG SF PAC SJV SB SV",
+        "7": "AK NV AZ OR EWA UT ID WWA MT WY",
+        "8": "MI WV OH",
+        "9": "IL WI IN",
+    }
+    # The land of maple syrup, prefix and call area, its sections and how common.
+    CANADIAN_AREAS = {
+        "VE1": ("NS", 4),
+        "VA1": ("NS", 1),
+        "VE2": ("QC", 15),
+        "VA2": ("QC", 5),
+        "VE3": ("ONE ONN ONS GH", 30),
+        "VA3": ("ONE ONN ONS GH", 10),
+        "VE4": ("MB", 3),
+        "VA4": ("MB", 1),
+        "VE5": ("SK", 3),
+        "VA5": ("SK", 1),
+        "VE6": ("AB", 8),
+        "VA6": ("AB", 3),
+        "VE7": ("BC", 12),
+        "VA7": ("BC", 4),
+        "VE8": ("TER", 1),
+        "VE9": ("NB", 3),
+        "VO1": ("NL", 2),
+        "VO2": ("NL", 1),
+        "VY0": ("TER", 1),
+        "VY1": ("TER", 1),
+        "VY2": ("PE", 1),
+    }
+    SUFFIX_LENGTHS = {1: 1, 2: 2, 3: 3}
+    CANADIAN_SUFFIX_LENGTHS = {2: 1, 3: 2}
+    CLASSES = {"A": 1, "B": 1, "C": 1, "D": 1, "E": 1, "F": 1}
+
+    def __init__(
+        self,
+        rng: random.Random = None,
+        database: CallsignIndex = None,
+        canadian_share: float = 0.1,
+        suffix_lengths: dict = None,
+        classes: dict = None,
+        batch_size: int = 256,
+    ):
+        self.rng = rng if rng is not None else random.Random()
+        self.database = database if database else None
+        self.canadian_share = canadian_share
+        self.batch_size = batch_size
+        self.sections = {
+            area: sections.split() for area, sections in self.CALL_AREAS.items()
+        }
+        self.canadian_prefixes = list(self.CANADIAN_AREAS)
+        self.canadian_weights = list(
+            itertools.accumulate(weight for _, weight in self.CANADIAN_AREAS.values())
+        )
+        self.canadian_sections = {
+            prefix: sections.split()
+            for prefix, (sections, _) in self.CANADIAN_AREAS.items()
+        }
+        self.suffix_lengths = self.weights(suffix_lengths or self.SUFFIX_LENGTHS)
+        self.canadian_suffix_lengths = self.weights(self.CANADIAN_SUFFIX_LENGTHS)
+        self.classes = self.weights(classes or self.CLASSES)
+        self.queue = deque()
+        self.in_use = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def weights(table: dict):
+        """A {choice: weight} table as choices and cumulative weights for Random.choices."""
+        return list(table), list(itertools.accumulate(table.values()))
+
+    def pick(self, table) -> str:
+        """Weighted pick from a table made by weights()."""
+        choices, cumulative = table
+        return self.rng.choices(choices, cum_weights=cumulative)[0]
+
+    def generate_class(self) -> str:
+        """A valid Field Day class"""
+        suffix = self.pick(self.classes)
+        if suffix in "CDE":
+            return "1" + suffix
+        if suffix == "B":
+            return str(self.rng.randint(1, 2)) + suffix
+        if suffix == "A":
+            return str(self.rng.randint(3, 20)) + suffix
+        return str(self.rng.randint(1, 20)) + suffix
+
+    def generate_us(self):
+        """A US callsign and a section in its call area."""
+        rng = self.rng
+        callsign = rng.choice("AKNW")
+        if callsign == "A":  # We have no choice. Must add second prefix.
+            callsign += self.LETTERS[rng.randint(0, 11)]
+            suffix_length = rng.randint(1, 2)
+        else:
+            if rng.randint(0, 2) == 0:
+                callsign += rng.choice(self.LETTERS)
+            suffix_length = self.pick(self.suffix_lengths)
+        area = str(rng.randint(0, 9))
+        callsign += area + "".join(rng.choices(self.LETTERS, k=suffix_length))
+        return callsign, rng.choice(self.sections[area])
+
+    def generate_canadian(self):
+        """A Canadian callsign and a section that goes with its prefix."""
+        prefix = self.rng.choices(
+            self.canadian_prefixes, cum_weights=self.canadian_weights
+        )[0]
+        suffix_length = self.pick(self.canadian_suffix_lengths)
+        callsign = prefix + "".join(self.rng.choices(self.LETTERS, k=suffix_length))
+        return callsign, self.rng.choice(self.canadian_sections[prefix])
+
+    def section_for(self, callsign: str) -> str:
+        """A likely section for a real callsign we don't know the section of."""
+        if callsign[:3] in self.canadian_sections:
+            return self.rng.choice(self.canadian_sections[callsign[:3]])
+        area = next((character for character in callsign if character.isdigit()), None)
+        if area is None:
+            area = self.rng.choice(list(self.sections))
+        return self.rng.choice(self.sections[area])
+
+    def generate(self):
+        """One station, (callsign, class, section)."""
+        if self.database is not None:
+            callsign, klass, section = self.database.sample(self.rng)
+            return (
+                callsign,
+                klass or self.generate_class(),
+                section or self.section_for(callsign),
+            )
+        if self.rng.random() < self.canadian_share:
+            callsign, section = self.generate_canadian()
+        else:
+            callsign, section = self.generate_us()
+        return callsign, self.generate_class(), section
+
+    def batch(self, size: int) -> list:
+        """size stations, none of them sharing a call with each other or the pileup."""
+        taken = self.in_use | {station[0] for station in self.queue}
+        if self.database is not None:
+            size = min(size, len(self.database) - len(taken))
+        stations = []
+        while len(stations) < size:
+            station = self.generate()
+            if station[0] not in taken:
+                taken.add(station[0])
+                stations.append(station)
+        return stations
+
+    def next(self):
+        """The next station to join the pileup, its call is now in use."""
+        with self.lock:
+            if not self.queue:
+                self.queue.extend(self.batch(self.batch_size))
+            if not self.queue:  # every call in the database is on the air
+                station = self.generate_us()
+                return station[0], self.generate_class(), station[1]
+            station = self.queue.popleft()
+            self.in_use.add(station[0])
+            return station
+
+    def release(self, callsign: str) -> None:
+        """The station has left the pileup, its call can be used again."""
+        with self.lock:
+            self.in_use.discard(callsign)
+
+
+Match = namedtuple(
+    "Match", "callsign distance error_level contained resend response partial"
+)
+Match.__doc__ = """How close the operators guess is to one caller's callsign.
+error_level is the edit distance over the callsign length, resend, response
+and partial say if it's under the 0.25, 0.5 and 0.8 thresholds the callers
+use for those messages, contained is the guess being part of the callsign."""
+
+
+class CallsignMatcher:
+    """
+    Scores a guessed callsign against every callsign in the pileup in one go.
+    It's Myers' bit parallel edit distance, each callsign is a row of bits in a
+    NumPy array, so the work is one pass over the guess however many callers
+    there are.
+    """
+
+    RESEND = 0.25
+    RESPONSE = 0.5
+    PARTIAL = 0.8
+
+    def __init__(self):
+        self.weights = np.left_shift(np.uint64(1), np.arange(64, dtype=np.uint64))
+
+    def distances(self, guess: str, callsigns) -> np.ndarray:
+        """Levenshtein distance from guess to each of the callsigns."""
+        count = len(callsigns)
+        lengths = np.array([len(callsign) for callsign in callsigns], dtype=np.int64)
+        width = int(lengths.max(initial=0))
+        if width > 63:
+            raise ValueError("Callsigns longer than 63 characters")
+        codes = np.zeros((count, max(width, 1)), dtype=np.uint32)
+        for row, callsign in enumerate(callsigns):
+            codes[row, : len(callsign)] = [ord(character) for character in callsign]
+        weights = self.weights[: codes.shape[1]]
+        full = np.left_shift(np.uint64(1), lengths.astype(np.uint64)) - np.uint64(1)
+        high = np.where(
+            lengths > 0,
+            np.left_shift(np.uint64(1), np.maximum(lengths - 1, 0).astype(np.uint64)),
+            np.uint64(0),
+        )
+        one = np.uint64(1)
+        vp = full.copy()
+        vn = np.zeros(count, dtype=np.uint64)
+        score = lengths.copy()
+        for character in guess:
+            eq = np.where(codes == ord(character), weights, np.uint64(0)).sum(
+                axis=1, dtype=np.uint64
+            )
+            xv = eq | vn
+            xh = (((eq & vp) + vp) ^ vp) | eq
+            hp = vn | ~(xh | vp)
+            hn = vp & xh
+            score += (hp & high) != 0
+            score -= (hn & high) != 0
+            hp = ((hp << one) | one) & full
+            hn = (hn << one) & full
+            vp = hn | ~(xv | hp) & full
+            vn = hp & xv
+        return np.where(lengths > 0, score, len(guess))
+
+    def rank(self, guess: str, callsigns) -> list:
+        """Every callsign as a Match, closest to the guess first."""
+        callsigns = list(callsigns)
+        if not callsigns:
+            return []
+        distances = self.distances(guess, callsigns)
+        matches = []
+        for callsign, distance in zip(callsigns, distances.tolist()):
+            error_level = distance / len(callsign) if callsign else float("inf")
+            matches.append(
+                Match(
+                    callsign,
+                    distance,
+                    error_level,
+                    guess in callsign,
+                    error_level < self.RESEND,
+                    error_level < self.RESPONSE,
+                    error_level < self.PARTIAL,
+                )
+            )
+        matches.sort(key=lambda match: match.error_level)
+        return matches
+
+    def match(self, guess: str, callsign: str) -> Match:
+        """Score a single callsign."""
+        return self.rank(guess, [callsign])[0]
+
+
+class EventKind(Enum):
+    """What the operator just sent."""
+
+    NONE = 0
+    CQ = 1
+    PARTIAL = 2
+    RESPONSE = 3
+    RESENDCLASS = 4
+    RESENDSECTION = 5
+    QRZ = 6
+    DIE = 7
+    TU = 8
+
+
+OperatorEvent = namedtuple(
+    "OperatorEvent", "kind serial generation guess matches posted"
+)
+OperatorEvent.__doc__ = """One thing the operator sent. serial goes up by one with
+every event, generation with every DIE. guess is the callsign that was sent, or
+for a TU the callsign that was worked, and matches maps each caller's callsign
+to its Match against it. posted is when, on the perf_counter() clock, for the
+instruments."""
+
+
+class PileupState:
+    """
+    What the operator last sent, and who thinks they're being worked, shared
+    by the window and the callers. Events are immutable and replaced whole, so
+    a caller reading state.event gets a consistent snapshot without locking.
+    """
+
+    GUESSES = (
+        EventKind.PARTIAL,
+        EventKind.RESPONSE,
+        EventKind.RESENDCLASS,
+        EventKind.RESENDSECTION,
+    )
+
+    def __init__(self, matcher: CallsignMatcher = None, clock=None):
+        self.lock = threading.Lock()
+        self.matcher = matcher if matcher is not None else CallsignMatcher()
+        self.clock = clock if clock is not None else time.monotonic
+        self.event = OperatorEvent(EventKind.NONE, 0, 0, "", {}, 0.0)
+        self.worked = None
+        self.called = self.clock()
+        self.speed = 0
+        self.resolve_time = 0.0
+
+    def publish(
+        self, kind: EventKind, guess: str = "", callsigns=(), called: bool = False
+    ) -> OperatorEvent:
+        """
+        Make kind the latest event. If it carries a guessed callsign, it's scored
+        against every one of callsigns here, once, rather than by each caller.
+        called is set when the operator has just asked for callers themselves,
+        that's what resolve_time is timed from, not the automatic re-prompts.
+        """
+        matches = {}
+        if kind is EventKind.TU:
+            guess = self.result()[0]
+        if kind in self.GUESSES:
+            matches = {
+                match.callsign: match
+                for match in self.matcher.rank(guess, filter(None, callsigns))
+            }
+        with self.lock:
+            self.event = OperatorEvent(
+                kind,
+                self.event.serial + 1,
+                self.event.generation + (kind is EventKind.DIE),
+                guess,
+                matches,
+                time.perf_counter(),
+            )
+            if called:
+                self.called = self.clock()
+            return self.event
+
+    def match(self, event: OperatorEvent, callsign: str) -> Match:
+        """How close the guess in event was to callsign."""
+        match = event.matches.get(callsign)
+        if match is None:
+            match = self.matcher.match(event.guess, callsign)
+        instruments.record("caller match", time.perf_counter() - event.posted)
+        return match
+
+    @property
+    def call_resolved(self) -> bool:
+        """Has a caller decided they're the one being worked."""
+        return self.worked is not None
+
+    def resolve(self, callsign: str, klass: str, section: str, speed: int = 0) -> None:
+        """A caller has decided they're the one being worked."""
+        with self.lock:
+            if self.worked is None or self.worked[0] != callsign:
+                self.speed = speed
+                self.resolve_time = self.clock() - self.called
+            self.worked = (callsign, klass, section)
+
+    def unresolve(self, callsign: str) -> None:
+        """A caller isn't sure anymore, only they can take their own claim back."""
+        with self.lock:
+            if self.worked is not None and self.worked[0] == callsign:
+                self.worked = None
+
+    def result(self) -> tuple:
+        """The callsign, class and section of whoever is being worked."""
+        worked = self.worked
+        return worked if worked is not None else ("", "", "")
+
+    def clear(self) -> None:
+        """Start afresh for the next contact."""
+        with self.lock:
+            self.worked = None
+
+
+@types.coroutine
+def suspend(request):
+    """Hands a request to the Pileup scheduler, returns whatever it resumes us with."""
+    return (yield request)
+
+
+class Pileup:
+    """
+    Runs every simulated caller as a coroutine, stepped by run_ready() from
+    whatever loop drives the audio. A caller awaits the operator, a pause, or
+    the end of its own transmission, and holds no thread while it waits, so
+    the pileup can be as big as you like.
+    """
+
+    def __init__(self, mixer, callsigns: CallsignGenerator = None, clock=None):
+        self.mixer = mixer
+        self.callsigns = callsigns if callsigns is not None else CallsignGenerator()
+        self.clock = clock if clock is not None else time.monotonic
+        self.lock = threading.Lock()
+        self.ready = deque()
+        self.timers = []
+        self.listeners = []
+        self.tasks = {}
+        self.counter = itertools.count()
+        self.state = PileupState(clock=self.clock)
+        # Set to a list to keep every transmission and operator event, in order.
+        self.timeline = None
+
+    def stop(self) -> None:
+        """Throw away every caller."""
+        for task in list(self.tasks):
+            task.close()
+        self.tasks.clear()
+
+    def spawn(self, ham) -> None:
+        """Add a caller to the pileup, safe to call from any thread."""
+        task = ham.run()
+        with self.lock:
+            self.tasks[task] = ham
+            self.ready.append((task, None))
+
+    def post(self, kind: EventKind, guess: str = "", called: bool = False) -> None:
+        """
+        Hand every caller a new event. A TU retires the caller that was worked
+        and a DIE every caller, there and then, so call it from whichever
+        thread is driving the pileup. called is set when the operator sent it.
+        """
+        callsigns = [ham.callsign for ham in list(self.tasks.values())]
+        event = self.state.publish(kind, guess, callsigns, called)
+        if kind is EventKind.TU and event.guess:
+            self.retire(event.guess)
+        elif kind is EventKind.DIE:
+            self.retire()
+        if self.timeline is not None:
+            self.timeline.append(
+                {"time": round(self.clock(), 3), "event": kind.name, "guess": guess}
+            )
+        with self.lock:
+            for task, _ in self.listeners:
+                self.ready.append((task, event))
+            self.listeners = []
+
+    def retire(self, callsign: str = None) -> None:
+        """Take a caller out of the pileup, or every caller if callsign is None."""
+        for task, ham in list(self.tasks.items()):
+            if ham.callsign and callsign in (None, ham.callsign):
+                del self.tasks[task]
+                task.close()
+                self.callsigns.release(ham.callsign)
+
+    def callers(self) -> int:
+        """How many callers are in the pileup."""
+        return sum(1 for ham in list(self.tasks.values()) if ham.callsign)
+
+    def wake(self, task, value=None) -> None:
+        """Put a waiting caller back on the run queue, safe to call from any thread."""
+        with self.lock:
+            self.ready.append((task, value))
+
+    async def sleep(self, seconds: float) -> None:
+        """Pause the calling caller."""
+        await suspend(("sleep", seconds))
+
+    async def listen(self, serial: int) -> OperatorEvent:
+        """Wait for an event newer than serial."""
+        return await suspend(("listen", serial))
+
+    async def transmit(self, channel, phrase: str) -> None:
+        """Key a phrase on a channel, resumes once it's been sent."""
+        await suspend(("transmit", (channel, phrase)))
+
+    def run_ready(self) -> int:
+        """
+        Step every caller that's ready, or due, until none are. Returns how
+        many steps were run.
+        """
+        steps = 0
+        while True:
+            with self.lock:
+                now = self.clock()
+                while self.timers and self.timers[0][0] <= now:
+                    self.ready.append((heapq.heappop(self.timers)[2], None))
+                if not self.ready:
+                    return steps
+                batch, self.ready = self.ready, deque()
+            for task, value in batch:
+                self.step(task, value)
+            steps += len(batch)
+
+    def sent(self, task, voice: Voice, posted: float) -> None:
+        """A transmission is done, let whoever sent it get on."""
+        if voice.started is not None and posted:
+            instruments.record("caller reply", voice.started - posted)
+        self.wake(task)
+
+    def step(self, task, value) -> None:
+        """Run one caller until it waits on something again."""
+        if task not in self.tasks:
+            return  # retired while it was waiting
+        if isinstance(value, OperatorEvent):
+            instruments.record("caller wake", time.perf_counter() - value.posted)
+        try:
+            kind, argument = task.send(value)
+        except StopIteration:
+            self.tasks.pop(task, None)
+            return
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Caller crashed")
+            self.tasks.pop(task, None)
+            return
+        if kind == "transmit":
+            channel, phrase = argument
+            if self.timeline is not None:
+                self.timeline.append(
+                    {
+                        "time": round(self.clock(), 3),
+                        "from": self.tasks[task].callsign or settings["MY_CALLSIGN"],
+                        "text": phrase,
+                    }
+                )
+            voice = channel.send(phrase)
+            # Only a caller's transmission is a reply to the latest event.
+            posted = self.state.event.posted if self.tasks[task].callsign else 0.0
+            voice.add_done_callback(functools.partial(self.sent, task, voice, posted))
+            return
+        with self.lock:
+            if kind == "sleep":
+                heapq.heappush(
+                    self.timers,
+                    (self.clock() + argument, next(self.counter), task),
+                )
+            elif kind == "listen":
+                event = self.state.event
+                if event.serial == argument:
+                    self.listeners.append((task, argument))
+                else:
+                    self.ready.append((task, event))
+
+
+Difficulty = namedtuple("Difficulty", "callers minimum_speed maximum_speed band_width")
+Difficulty.__doc__ = """How hard a pileup is: how many callers, the range of
+speeds they send at, and how wide a spread of pitches, in Hz, they're on."""
+
+
+class Ham:
+    """This is the simulated Field Day participant."""
+
+    def __init__(
+        self,
+        n,
+        pileup,
+        station,
+        rng: random.Random = None,
+        difficulty: Difficulty = None,
+    ):
+        self.n = n
+        self.pileup = pileup
+        self.rng = rng if rng is not None else random.Random()
+        self.difficulty = (
+            difficulty
+            if difficulty is not None
+            else DifficultyController.from_settings()
+        )
+        self.channel = None
+        self.state = "CQ"
+        self.callsign, self.klass, self.section = station
+        self.speed = 0
+        # Remember where the conversation is now, so a CQ sent before this
+        # caller gets going isn't missed.
+        self.serial = pileup.state.event.serial
+        self.generation = pileup.state.event.generation
+
+    async def run(self):
+        """Main loop for simulant, sleeps until the operator sends something."""
+        half_bandwidth = self.difficulty.band_width // 2
+        pitch = self.rng.randint(
+            settings["SIDE_TONE"] - half_bandwidth,
+            settings["SIDE_TONE"] + half_bandwidth,
+        )
+        self.speed = self.rng.randint(
+            self.difficulty.minimum_speed, self.difficulty.maximum_speed
+        )
+        volume = self.rng.uniform(0.1, 0.3)
+        self.channel = self.pileup.mixer.channel(pitch, self.speed, volume)
+        if self.pileup.mixer.band is not None:
+            self.channel.propagation = self.pileup.mixer.band.propagation(self.rng)
+
+        try:
+            while True:
+                event = await self.pileup.listen(self.serial)
+                if event.generation != self.generation:
+                    break
+                self.serial = event.serial
+                await self.handle(event)
+        finally:
+            self.channel.close()
+            self.pileup.callsigns.release(self.callsign)
+        self.log("DIEDIEDIE")
+
+    async def handle(self, event: OperatorEvent) -> None:
+        """
+        Run an event through the state machine. A handler returns True when
+        it changed state and the same event should be looked at again.
+        """
+        handlers = {
+            "CQ": self.on_cq,
+            "RESOLVINGCALL": self.on_resolving_call,
+            "CALLRESOLVED": self.on_call_resolved,
+        }
+        if event.kind in (EventKind.CQ, EventKind.TU):
+            # Back to waiting for a CQ, a TU means somebody else got the contact.
+            self.state = "CQ"
+        while await handlers[self.state](event):
+            pass
+
+    async def on_cq(self, event: OperatorEvent) -> bool:
+        """Waiting for a CQ, answer it with our call."""
+        self.log(f"{self.callsign}: {self.state}")
+        if event.kind is EventKind.CQ:
+            # slightly random start time
+            await self.pileup.sleep(0.1 * self.rng.randint(1, 10))
+            await self.send(self.callsign)
+            self.state = "RESOLVINGCALL"
+        return False
+
+    async def on_resolving_call(self, event: OperatorEvent) -> bool:
+        """Operator is trying to pick a call out of the pileup, is it us?"""
+        state = self.pileup.state
+        if event.kind is EventKind.PARTIAL:
+            match = state.match(event, self.callsign)
+            self.log(
+                f"{self.callsign}: {self.state} {event.kind.name} {match.error_level}"
+            )
+            if match.distance == 0:
+                state.resolve(self.callsign, self.klass, self.section, self.speed)
+                await self.react()
+                await self.send("rr")
+                self.state = "CALLRESOLVED"
+            elif (
+                not state.call_resolved
+                and match.partial
+                or event.guess == "?"
+                or match.contained
+            ):
+                await self.react()
+                await self.send(self.callsign)
+            return False
 
-    def time_for_phrase(self, wpm: int, phrase: str) -> int:
-        """Converts a string into the miliseconds needed to send it, given the wpm"""
-        miliseconds_per_element = 60 / (50 * wpm) * 1000
-        elements = 0
-        for character in phrase.upper():
-            elements += self.character_timing[character]
-            elements += len(phrase)  # one element pause between characters
-        return ceil((miliseconds_per_element * elements) / 1000) + 2
+        if event.kind is EventKind.RESPONSE:
+            match = state.match(event, self.callsign)
+            self.log(
+                f"{self.callsign}: {self.state} {event.kind.name} {match.error_level}"
+            )
+            if match.distance == 0:
+                state.resolve(self.callsign, self.klass, self.section, self.speed)
+                await self.react()
+                await self.send(f"TU {self.klass} {self.section}")
+                self.state = "CALLRESOLVED"
+            elif (
+                not state.call_resolved and match.response or match.contained
+            ):  # could be me
+                await self.react()
+                await self.send(f"DE {self.callsign} {self.klass} {self.section}")
+            return False
 
+        if event.kind in (EventKind.RESENDCLASS, EventKind.RESENDSECTION):
+            match = state.match(event, self.callsign)
+            self.log(
+                f"{self.callsign}: {self.state} {event.kind.name} {match.error_level}"
+            )
+            if match.resend:  # if close he must be talking to me right?
+                state.resolve(self.callsign, self.klass, self.section, self.speed)
+                self.state = "CALLRESOLVED"
+                return True
+        return False
 
-class Ham(QRunnable):
-    """This is the simulated Field Day participant."""
+    async def on_call_resolved(self, event: OperatorEvent) -> bool:
+        """We're the one being worked, give the exchange as asked."""
+        state = self.pileup.state
+        self.log(f"{self.callsign}: {self.state} {event.kind.name}")
+        if event.kind is EventKind.PARTIAL:
+            # If he's resending a callsign it's not resolved
+            state.unresolve(self.callsign)
+            self.state = "RESOLVINGCALL"
+            return True
+        state.resolve(self.callsign, self.klass, self.section, self.speed)
+        if event.kind is EventKind.RESPONSE:
+            await self.react()
+            await self.send(f"tu {self.klass} {self.section}")
+        if event.kind is EventKind.RESENDCLASS:
+            await self.react()
+            await self.send(f"{self.klass} {self.klass}")
+        if event.kind is EventKind.RESENDSECTION:
+            await self.react()
+            await self.send(f"{self.section} {self.section}")
+        return False
 
-    def __init__(self, n):
-        super().__init__()
-        self.n = n
-        self.timetosend = CalculatePhraseTime()
+    async def react(self) -> None:
+        """The pause a human takes to hear the end of a message and start sending."""
+        await self.pileup.sleep(self.rng.uniform(0.1, 0.4))
 
-    def run(self):
-        """Main loop for simulant"""
-        global call_resolved
-        global result
-        current_state = "CQ"
-        random.seed()
-        callsign = self.generate_callsign()
-        klass = self.generate_class()
-        section = self.generate_section(callsign)
-        half_bandwidth = settings["BAND_WIDTH"] / 2
-        pitch = random.randint(
-            settings["SIDE_TONE"] - half_bandwidth,
-            settings["SIDE_TONE"] + half_bandwidth,
+    async def send(self, morse_output: str) -> None:
+        """Key a message at this callers pitch, speed and volume, wait till it's sent."""
+        await self.pileup.transmit(self.channel, morse_output)
+
+    @staticmethod
+    def log(line: str) -> None:
+        """This is here because I'm too lazy to convert all the 'f' strings to %s crap."""
+        logging.info(line)
+
+
+class Session:
+    """
+    One sitting at the radio. Everything the operator does to the pileup goes
+    through here and is applied by the audio thread at the start of a period,
+    so it lands on an exact sample, and is logged against that sample. All the
+    randomness comes from one seed, so the seed, the settings and the log are
+    all it takes to play a session again bit for bit. It stands in for the
+    Mixer in front of an AudioOutput.
+    """
+
+    def __init__(self, mixer: Mixer, seed: int = None, script=()):
+        self.mixer = mixer
+        self.sample_rate = mixer.sample_rate
+        self.period = mixer.period
+        self.seed = seed if seed is not None else random.randrange(2**32)
+        self.rng = random.Random(self.seed)
+        self.pileup = Pileup(
+            mixer,
+            CallsignGenerator(
+                rng=random.Random(self.rng.getrandbits(64)),
+                database=CallsignIndex.from_settings(),
+                canadian_share=settings["CANADIAN_CALLERS"] / 100,
+            ),
+            clock=mixer.time,
         )
-        speed = random.randint(
-            settings["MINIMUM_CALLER_SPEED"], settings["MAXIMUM_CALLER_SPEED"]
+        mixer.band = Band(mixer, self.seed)
+        mixer.receiver = Receiver(
+            mixer, settings["RECEIVER_FILTER"], settings["FILTER_WIDTHS"]
         )
-        volume = random.uniform(0.1, 0.3)
+        self.channel = mixer.channel(settings["SIDE_TONE"], settings["MY_SPEED"], 0.3)
+        mixer.sidetone = self.channel
+        mixer.keyer = Keyer(mixer, settings["SIDE_TONE"], settings["MY_SPEED"])
+        self.actions = queue.SimpleQueue()
+        self.script = deque(script)
+        self.log = []
+        self.checksum = 0
+        self.mismatches = 0
+        self.on_send = None
+
+    def send(
+        self,
+        morse_output: str,
+        kind: EventKind = None,
+        guess: str = "",
+        keyed: bool = False,
+    ) -> None:
+        """
+        Key a message, the event is posted to the callers once it's been sent.
+        A keyed message has already gone out on the key, so it's not sent again.
+        """
+        action = {
+            "action": "send",
+            "text": morse_output,
+            "kind": kind.name if kind is not None else None,
+            "guess": guess,
+        }
+        if keyed:
+            action["keyed"] = True
+        self.request(action)
 
-        side_tone = f"-f {pitch}"
-        wpm = f"-w {speed}"
-        vol = f"-v {volume}"
-        answered_message = False
+    def key(self, down: bool) -> None:
+        """The straight key went down or came up."""
+        self.request({"action": "key", "down": down})
 
-        while True:
+    def paddles(self, dit: bool, dah: bool) -> None:
+        """Which paddles are pressed now."""
+        self.request({"action": "paddles", "dit": dit, "dah": dah})
+
+    def post(self, kind: EventKind, guess: str = "") -> None:
+        """Hand the callers an event without sending anything."""
+        self.request({"action": "post", "kind": kind.name, "guess": guess})
+
+    def clear(self) -> None:
+        """Forget who was being worked."""
+        self.request({"action": "clear"})
+
+    def spawn(self, difficulty: Difficulty) -> None:
+        """Top the pileup up, or trim it, to difficulty.callers."""
+        self.request({"action": "spawn", **difficulty._asdict()})
+
+    def filter(self, width: int) -> None:
+        """Switch the receiver to a filter width Hz wide."""
+        self.request({"action": "filter", "width": width})
+
+    def qso(self, logged, worked) -> None:
+        """Note what the operator logged, and who they really worked."""
+        self.request({"action": "qso", "logged": logged, "worked": worked})
+
+    def request(self, action: dict) -> None:
+        """Queue an action for the audio thread, noting when for the instruments."""
+        self.actions.put((action, time.perf_counter()))
+
+    def apply(self, sample: int, action: dict) -> None:
+        """Do what the operator asked, run from the audio thread."""
+        self.log.append(
+            {"sample": sample, "time": round(sample / self.sample_rate, 3), **action}
+        )
+        name = action["action"]
+        if name == "send":
+            kind = EventKind[action["kind"]] if action["kind"] else None
+            if action.get("keyed"):
+                voice = self.channel.play(np.zeros(0, dtype=np.float32))
+            else:
+                voice = self.channel.send(action["text"])
+            voice.add_done_callback(functools.partial(self.sent, voice))
+            if kind is not None:
+                voice.add_done_callback(
+                    functools.partial(
+                        self.pileup.post,
+                        kind,
+                        action["guess"],
+                        kind in (EventKind.CQ, EventKind.TU),
+                    )
+                )
+            if self.on_send is not None:
+                self.on_send(action["text"], kind, voice)
+        elif name == "post":
+            self.pileup.post(EventKind[action["kind"]], action["guess"])
+        elif name == "clear":
+            self.pileup.state.clear()
+        elif name == "spawn":
+            difficulty = DifficultyController.from_settings()._replace(
+                **{key: action[key] for key in Difficulty._fields if key in action}
+            )
+            # Callers sending at an older speed or spread leave, bar the one
+            # being worked, so easing off or speeding up reaches the whole
+            # pileup at once. The pileup size is only topped up or trimmed.
+            worked = self.pileup.state.worked
+            waiting = [
+                ham
+                for ham in list(self.pileup.tasks.values())
+                if ham.callsign and (worked is None or worked[0] != ham.callsign)
+            ]
+            for ham in list(waiting):
+                if ham.difficulty._replace(callers=difficulty.callers) != difficulty:
+                    self.pileup.retire(ham.callsign)
+                    waiting.remove(ham)
+            callers = self.pileup.callers()
+            while callers > difficulty.callers and waiting:
+                self.pileup.retire(waiting.pop().callsign)
+                callers -= 1
+            for i in range(callers, difficulty.callers):
+                self.pileup.spawn(
+                    Ham(
+                        i,
+                        self.pileup,
+                        self.pileup.callsigns.next(),
+                        random.Random(self.rng.getrandbits(64)),
+                        difficulty,
+                    )
+                )
+        elif name == "key":
+            self.mixer.keyer.key(action["down"])
+        elif name == "paddles":
+            self.mixer.keyer.paddles(action["dit"], action["dah"])
+        elif name == "filter":
+            self.mixer.receiver.select(action["width"])
+        elif name == "qso":
+            if list(self.pileup.state.result()) != list(action["worked"]):
+                self.mismatches += 1
 
-            if "DIE " in message:
+    @staticmethod
+    def sent(voice: Voice) -> None:
+        """The operator's message is done, time how it went."""
+        if voice.started is not None:
+            instruments.record("operator start", voice.started - voice.created)
+            instruments.record("operator transmit", time.perf_counter() - voice.started)
+
+    def callback(self, frames: int) -> np.ndarray:
+        """
+        Apply whatever the operator has done, let the callers react, then hand
+        the audio output its next frames, the way the mixer would.
+        """
+        sample = self.mixer.ring.read
+        while self.script and self.script[0]["sample"] <= sample:
+            action = dict(self.script.popleft())
+            del action["sample"]
+            action.pop("time", None)
+            self.apply(sample, action)
+        while True:
+            try:
+                action, queued = self.actions.get_nowait()
+            except queue.Empty:
                 break
+            instruments.record("operator queue", time.perf_counter() - queued)
+            self.apply(sample, action)
+        self.pileup.run_ready()
+        block = self.mixer.callback(frames)
+        self.checksum = zlib.crc32(block.tobytes(), self.checksum)
+        return block
+
+    def release(self) -> None:
+        """Wake everyone waiting on a voice, used when shutting down."""
+        self.mixer.release()
+
+    def record(self) -> dict:
+        """Everything needed to play this session again."""
+        return {
+            "seed": self.seed,
+            "sample_rate": self.sample_rate,
+            "period": self.period,
+            "samples": self.mixer.ring.read,
+            "checksum": self.checksum,
+            "settings": settings,
+            "actions": self.log,
+        }
+
+    def save(self, path: str) -> None:
+        """Write the record of this session to path."""
+        with open(path, "wt", encoding="utf-8") as file_descriptor:
+            file_descriptor.write(dumps(self.record(), indent=1))
+
+
+class OperatorAgent:
+    """
+    A pretend operator for running the pileup with nobody at the keyboard.
+    It calls CQ, picks one of the callers, copies their call with the odd
+    mistake, and works them, over and over. It peeks at the callers rather
+    than decoding them, it's there to exercise the pileup, not to copy CW.
+    """
+
+    callsign = ""  # not a caller, so nothing for the matcher to score
+
+    def __init__(self, pileup, channel, spawn, rng: random.Random, accuracy=0.9):
+        self.pileup = pileup
+        self.channel = channel
+        self.spawn = spawn
+        self.rng = rng
+        self.accuracy = accuracy
+        self.qsos = []
+
+    def copy(self, text: str) -> str:
+        """What the operator thinks they heard, usually right."""
+        if not text or self.rng.random() < self.accuracy:
+            return text
+        position = self.rng.randrange(len(text))
+        wrong = self.rng.choice(CallsignGenerator.LETTERS + "0123456789")
+        return text[:position] + wrong + text[position + 1 :]
+
+    async def send(self, morse_output: str, kind: EventKind, guess: str = "") -> None:
+        """Send a message then let the callers know what it was."""
+        await self.pileup.transmit(self.channel, morse_output)
+        self.pileup.post(kind, guess, kind in (EventKind.CQ, EventKind.TU))
+
+    async def wait_for_quiet(self, gap: float = 0.6) -> None:
+        """Wait till none of the callers has sent anything for gap seconds."""
+        quiet = 0.0
+        while quiet < gap:
+            await self.pileup.sleep(0.1)
+            busy = any(
+                channel.queue
+                for channel in self.pileup.mixer.channels
+                if channel is not self.channel
+            )
+            quiet = 0.0 if busy else quiet + 0.1
+
+    async def run(self):
+        """Run contacts till the pileup is stopped."""
+        state = self.pileup.state
+        while True:
+            state.clear()
+            await self.send(f"CQ FD DE {settings['MY_CALLSIGN']}", EventKind.CQ)
+            await self.pileup.sleep(1.1)
+            await self.wait_for_quiet()
+            callers = [
+                ham
+                for ham in list(self.pileup.tasks.values())
+                if getattr(ham, "state", "") == "RESOLVINGCALL"
+            ]
+            if not callers:
+                continue
+            target = self.rng.choice(callers)
+            for _ in range(3):
+                guess = self.copy(target.callsign)
+                await self.send(
+                    f"{guess} {settings['MY_CLASS']} {settings['MY_SECTION']}",
+                    EventKind.RESPONSE,
+                    guess,
+                )
+                await self.wait_for_quiet()
+                if state.call_resolved:
+                    break
+            else:
+                continue
+            worked = state.result()
+            logged = (guess, self.copy(worked[1]), self.copy(worked[2]))
+            self.pileup.post(EventKind.QRZ)
+            await self.send(f"tu {settings['MY_CALLSIGN']} fd", EventKind.TU)
+            self.qsos.append((self.pileup.clock(), worked, logged))
+            self.spawn()
+
+
+class Simulation:
+    """
+    The pileup without the window. Callers, the pretend operator and the mixer
+    all run on the calling thread, with time kept by how much audio has been
+    rendered, so a session runs as fast as the CPU allows, or in real time if
+    asked. Everything random comes from the one seed, so the same seed and
+    settings always make the same session. Given the actions logged by a
+    Session instead, it plays that session again with no pretend operator.
+    The audio goes to a WAV or Opus file, with a JSON timeline beside it, or
+    nowhere.
+    """
+
+    def __init__(
+        self,
+        callers: int,
+        path: str = None,
+        accuracy: float = 0.9,
+        seed: int = None,
+        script=None,
+        mixer: Mixer = None,
+    ):
+        self.callers = callers
+        self.mixer = mixer if mixer is not None else Mixer()
+        self.session = Session(self.mixer, seed, script or ())
+        self.seed = self.session.seed
+        self.pileup = self.session.pileup
+        self.pileup.timeline = []
+        self.agent = None
+        if script is None:
+            self.agent = OperatorAgent(
+                self.pileup,
+                self.session.channel,
+                self.spawn,
+                random.Random(self.session.rng.getrandbits(64)),
+                accuracy,
+            )
+        self.audio = SessionAudio(path, self.mixer.sample_rate) if path else None
+
+    @classmethod
+    def replay(cls, record: dict, path: str = None):
+        """A simulation that plays back a session saved by Session.save()."""
+        settings.update(record["settings"])
+        return cls(
+            0,
+            path,
+            seed=record["seed"],
+            script=record["actions"],
+            mixer=Mixer(record["sample_rate"], record["period"]),
+        )
+
+    def spawn(self) -> None:
+        """Fill the pileup back up."""
+        self.session.spawn(DifficultyController.from_settings(self.callers))
+
+    def run(self, seconds: float, realtime: bool = False) -> None:
+        """Simulate seconds of operating."""
+        if self.agent is not None:
+            self.spawn()
+            self.pileup.spawn(self.agent)
+        period = self.mixer.period
+        started = time.monotonic()
+        while self.mixer.time() < seconds:
+            block = self.session.callback(period)
+            if self.audio is not None:
+                self.audio.write(block)
+            if realtime:
+                ahead = self.mixer.time() - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        self.close()
+
+    def qsos(self) -> list:
+        """When each contact was logged, who was worked and what was logged."""
+        if self.agent is not None:
+            return [
+                (when, list(worked), list(logged))
+                for when, worked, logged in self.agent.qsos
+            ]
+        return [
+            (action["time"], action["worked"], action["logged"])
+            for action in self.session.log
+            if action["action"] == "qso"
+        ]
+
+    def timeline(self) -> dict:
+        """How the session was made and everything that was sent in it."""
+        return {
+            "seed": self.seed,
+            "callers": self.callers,
+            "seconds": round(self.mixer.time(), 3),
+            "sample_rate": self.mixer.sample_rate,
+            "audio": Path(self.audio.path).name if self.audio else None,
+            "settings": settings,
+            "timeline": self.pileup.timeline,
+            "qsos": [
+                {"time": round(when, 3), "worked": worked, "logged": logged}
+                for when, worked, logged in self.qsos()
+            ],
+        }
+
+    def close(self) -> None:
+        """Throw away the callers and finish the audio and its timeline."""
+        self.pileup.stop()
+        if self.audio is not None:
+            self.audio.close()
+            timeline_path = Path(self.audio.path).with_suffix(".json")
+            with open(timeline_path, "wt", encoding="utf-8") as file_descriptor:
+                file_descriptor.write(dumps(self.timeline(), indent=1))
+            self.audio = None
+
+
+def benchmark(counts, seconds: float = 120) -> None:
+    """
+    Run a headless session for each pileup size in counts and print how the
+    caller loop, timing model and matcher scale.
+    """
+    print(
+        f"{'callers':>7} {'QSOs':>5} {'QSO/s':>8} {'react p50':>10} "
+        f"{'react p99':>10} {'CPU/caller':>11} {'KiB/caller':>11}"
+    )
+    for callers in counts:
+        simulation = Simulation(callers)
+        instruments.reset()
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        simulation.run(seconds)
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        qsos = len(simulation.qsos())
+        wake = instruments.histograms.get("caller wake", Histogram())
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        simulation = Simulation(callers)
+        simulation.run(10)
+        memory = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        print(
+            f"{callers:>7} {qsos:>5} {qsos / wall:>8.2f} "
+            f"{wake.percentile(50):>8}us "
+            f"{wake.percentile(99):>8}us "
+            f"{100 * cpu / seconds / callers:>10.3f}% "
+            f"{memory / callers / 1024:>11.1f}"
+        )
+
+
+QSO = namedtuple(
+    "QSO",
+    "time callsign klass section logged_callsign logged_class logged_section "
+    "speed resolve_time",
+)
+QSO.__doc__ = """One contact. time is when it was logged, seconds since the epoch.
+callsign, klass and section are what the caller really sent, the logged_ ones
+what the operator copied. speed is the caller's WPM and resolve_time how many
+seconds it took from the operator's CQ, or the TU before, to the caller knowing
+they were being worked."""
 
-            if message != answered_message:
-                answered_message = message  # store timestamp
-
-                if "CQ " in message:
-                    current_state = "CQ"
-
-                if current_state == "CQ":  # Waiting for CQ call
-                    self.log(f"{callsign}: {current_state}")
-                    if "CQ " in message:  # different timestamp?
-                        time.sleep(
-                            0.1 * random.randint(1, 10)
-                        )  # slightly random start time
-                        morse_output = f"{callsign}"
-                        time_to_send = self.timetosend.time_for_phrase(
-                            speed, morse_output
-                        )
-                        self.log(f"{callsign}: {current_state} {time_to_send}")
-                        try:
-                            subprocess.run(
-                                ["morse", side_tone, wpm, vol, morse_output],
-                                timeout=time_to_send,
-                                check=False,
-                            )
-                        except subprocess.TimeoutExpired:
-                            self.log(
-                                f"Morse Timeout: '{morse_output}' [{time_to_send}]"
-                            )
-                        answered_message = message  # store timestamp
-                        current_state = "RESOLVINGCALL"
-
-                if current_state == "RESOLVINGCALL" and "PARTIAL " in message:
-                    error_level = self.run_ltest(callsign, guessed_callsign)
-                    self.log(f"{callsign}: {current_state} {message} {error_level}")
-                    if error_level == 0.0:
-                        morse_output = "rr"
-                        time_to_send = self.timetosend.time_for_phrase(
-                            speed, morse_output
-                        )
-                        try:
-                            subprocess.run(
-                                ["morse", side_tone, wpm, vol, morse_output],
-                                timeout=time_to_send,
-                                check=False,
-                            )
-                        except subprocess.TimeoutExpired:
-                            self.log(
-                                f"Morse Timeout: '{morse_output}' [{time_to_send}]"
-                            )
-                        current_state = "CALLRESOLVED"
-                        call_resolved = True
-                        answered_message = message
-                        continue
-                    elif (
-                        not call_resolved
-                        and error_level < 0.8
-                        or guessed_callsign == "?"
-                        or guessed_callsign in callsign
-                    ):
-                        morse_output = f"{callsign}"
-                        time_to_send = self.timetosend.time_for_phrase(
-                            speed, morse_output
-                        )
-                        try:
-                            subprocess.run(
-                                ["morse", side_tone, wpm, vol, morse_output],
-                                timeout=time_to_send,
-                                check=False,
-                            )
-                        except subprocess.TimeoutExpired:
-                            self.log(
-                                f"Morse Timeout: '{morse_output}' [{time_to_send}]"
-                            )
-
-                if current_state == "RESOLVINGCALL" and "RESPONSE " in message:
-                    error_level = self.run_ltest(callsign, guessed_callsign)
-                    self.log(f"{callsign}: {current_state} {message} {error_level}")
-                    if error_level == 0.0:
-                        result = [callsign, klass, section]
-                        morse_output = f"TU {klass} {section}"
-                        time_to_send = self.timetosend.time_for_phrase(
-                            speed, morse_output
-                        )
-                        try:
-                            subprocess.run(
-                                ["morse", side_tone, wpm, vol, morse_output],
-                                timeout=time_to_send,
-                                check=False,
-                            )
-                        except subprocess.TimeoutExpired:
-                            self.log(
-                                f"Morse Timeout: '{morse_output}' [{time_to_send}]"
-                            )
-                        current_state = "CALLRESOLVED"
-                        call_resolved = True
-                        continue
-                    elif (
-                        not call_resolved
-                        and error_level < 0.5
-                        or guessed_callsign in callsign
-                    ):  # could be me
-                        morse_output = f"DE {callsign} {klass} {section}"
-                        time_to_send = self.timetosend.time_for_phrase(
-                            speed, morse_output
-                        )
-                        try:
-                            subprocess.run(
-                                ["morse", side_tone, wpm, vol, morse_output],
-                                timeout=time_to_send,
-                                check=False,
-                            )
-                        except subprocess.TimeoutExpired:
-                            self.log(
-                                f"Morse Timeout: '{morse_output}' [{time_to_send}]"
-                            )
-
-                if current_state == "RESOLVINGCALL" and "RESEND" in message:
-                    error_level = self.run_ltest(callsign, guessed_callsign)
-                    self.log(f"{callsign}: {current_state} {message} {error_level}")
-                    if error_level < 0.25:  # if close he must be talking to me right?
-                        current_state = "CALLRESOLVED"
-                        call_resolved = True
-
-                if current_state == "CALLRESOLVED":
-                    self.log(f"{callsign}: {current_state} {message}")
-                    result = [callsign, klass, section]
-                    if "PARTIAL " in message:
-                        # If he's resending a callsign it's not resolved
-                        current_state = "RESOLVINGCALL"
-                        call_resolved = False
-                        answered_message = False
-                        continue
-                    if "RESPONSE " in message:
-                        morse_output = f"tu {klass} {section}"
-                        time_to_send = self.timetosend.time_for_phrase(
-                            speed, morse_output
-                        )
-                        try:
-                            subprocess.run(
-                                ["morse", side_tone, wpm, vol, morse_output],
-                                timeout=time_to_send,
-                                check=False,
-                            )
-                        except subprocess.TimeoutExpired:
-                            self.log(
-                                f"Morse Timeout: '{morse_output}' [{time_to_send}]"
-                            )
-                    if "RESENDCLASS" in message:
-                        morse_output = f"{klass} {klass}"
-                        time_to_send = self.timetosend.time_for_phrase(
-                            speed, morse_output
-                        )
-                        try:
-                            subprocess.run(
-                                ["morse", side_tone, wpm, vol, morse_output],
-                                timeout=time_to_send,
-                                check=False,
-                            )
-                        except subprocess.TimeoutExpired:
-                            self.log(
-                                f"Morse Timeout: '{morse_output}' [{time_to_send}]"
-                            )
-                    if "RESENDSECTION" in message:
-                        morse_output = f"{section} {section}"
-                        time_to_send = self.timetosend.time_for_phrase(
-                            speed, morse_output
-                        )
-                        try:
-                            subprocess.run(
-                                ["morse", side_tone, wpm, vol, morse_output],
-                                timeout=time_to_send,
-                                check=False,
-                            )
-                        except subprocess.TimeoutExpired:
-                            self.log(
-                                f"Morse Timeout: '{morse_output}' [{time_to_send}]"
-                            )
-                    if "QRZ" in message:
-                        result = [callsign, klass, section]
-            time.sleep(0.1)  # This is here just so CPU cores arn't 100%
-        self.log("DIEDIEDIE")
+
+class ContestLog:
+    """
+    Every contact, kept in memory and in an append only journal, one JSON
+    object a line. Adding a contact only queues it, a writer thread appends
+    whatever has queued up and fsyncs once a batch, so a run of contacts
+    costs one fsync and the window never waits on the disk.
+    """
+
+    FREQUENCY = 7030
+    BAND = "40m"
+
+    def __init__(self, path: str, interval: float = 1.0):
+        self.path = path
+        self.interval = interval
+        self.qsos = self.load(path)
+        self.torn = self.torn_tail(path)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.writer, name="journal", daemon=True)
+        self.thread.start()
 
     @staticmethod
-    def generate_class():
-        """Generates a valid Field Day class"""
-        suffix = ["A", "B", "C", "D", "E", "F"][random.randint(0, 5)]
-        if "C" in suffix:
-            return "1C"
-        if "D" in suffix:
-            return "1D"
-        if "E" in suffix:
-            return "1E"
-        if "B" in suffix:
-            return str(random.randint(1, 2)) + suffix
-        if "A" in suffix:
-            return str(random.randint(3, 20)) + suffix
-
-        return str(random.randint(1, 20)) + suffix
+    def load(path: str) -> list:
+        """Read back a journal, a line cut short by a crash is skipped."""
+        qsos = []
+        if not os.path.exists(path):
+            return qsos
+        with open(path, "rt", encoding="utf-8") as file_descriptor:
+            for number, line in enumerate(file_descriptor, 1):
+                try:
+                    qsos.append(QSO(**loads(line)))
+                except (ValueError, TypeError):
+                    logging.warning("%s line %d unreadable, skipped", path, number)
+        return qsos
 
     @staticmethod
-    def generate_callsign():
-        """Generates a US callsign, Need to add the land of maple syrup."""
-        prefix = ["A", "K", "N", "W"]
-        letters = [
-            "A",
-            "B",
-            "C",
-            "D",
-            "E",
-            "F",
-            "G",
-            "H",
-            "I",
-            "J",
-            "K",
-            "L",
-            "M",
-            "N",
-            "O",
-            "P",
-            "Q",
-            "R",
-            "S",
-            "T",
-            "U",
-            "V",
-            "W",
-            "X",
-            "Y",
-            "Z",
+    def torn_tail(path: str) -> bool:
+        """Does the journal end part way through a line."""
+        try:
+            with open(path, "rb") as file_descriptor:
+                file_descriptor.seek(-1, os.SEEK_END)
+                return file_descriptor.read(1) != b"\n"
+        except OSError:
+            return False
+
+    def add(self, qso: QSO) -> None:
+        """Log a contact."""
+        self.qsos.append(qso)
+        self.queue.put(qso)
+
+    def writer(self) -> None:
+        """Append queued contacts to the journal, a batch at a time."""
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while batch[-1] is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                running = False
+            if not batch:
+                continue
+            try:
+                with open(self.path, "at", encoding="utf-8") as journal:
+                    if self.torn:
+                        journal.write("\n")
+                        self.torn = False
+                    journal.writelines(dumps(qso._asdict()) + "\n" for qso in batch)
+                    journal.flush()
+                    os.fsync(journal.fileno())
+            except OSError as exception:
+                logging.warning("Writing %s: %s", self.path, exception)
+
+    def close(self) -> None:
+        """Write out anything still queued."""
+        self.queue.put(None)
+        self.thread.join(5)
+
+    def cabrillo(self, path: str) -> None:
+        """Export the log as a Field Day Cabrillo file, with what was copied."""
+        lines = [
+            "START-OF-LOG: 3.0",
+            "CREATED-BY: Field Day Morse Trainer",
+            "CONTEST: ARRL-FD",
+            f"CALLSIGN: {settings['MY_CALLSIGN']}",
+            f"LOCATION: {settings['MY_SECTION']}",
+            "CATEGORY-MODE: CW",
         ]
-        callsign = prefix[random.randint(0, 3)]
+        for qso in self.qsos:
+            when = time.strftime("%Y-%m-%d %H%M", time.gmtime(qso.time))
+            lines.append(
+                f"QSO: {self.FREQUENCY:>5} CW {when} "
+                f"{settings['MY_CALLSIGN']:<10} {settings['MY_CLASS']:<3} "
+                f"{settings['MY_SECTION']:<5} {qso.logged_callsign:<10} "
+                f"{qso.logged_class:<3} {qso.logged_section}"
+            )
+        lines.append("END-OF-LOG:")
+        with open(path, "wt", encoding="utf-8") as file_descriptor:
+            file_descriptor.write("\n".join(lines) + "\n")
 
-        add_second_prefix_letter = random.randint(0, 2) == 0
-        if "A" in callsign:  # We have no choice. Must add second prefix.
-            callsign += letters[random.randint(0, 11)]
-            add_second_prefix_letter = False
+    def adif(self, path: str) -> None:
+        """
+        Export the log as ADIF, with what was copied, and what was really sent,
+        the caller's speed and the time to resolve them as APP_FDMT_ fields.
+        """
 
-        if add_second_prefix_letter:
-            callsign += letters[random.randint(0, 25)]
+        def field(name: str, value) -> str:
+            value = str(value)
+            return f"<{name}:{len(value)}>{value} "
 
-        callsign += str(random.randint(0, 9))
-        if "A" in callsign[0]:
-            suffix_length = random.randint(1, 2)
-        else:
-            length = [
-                1,
-                2,
-                2,
-                3,
-                3,
-                3,
-            ]  # Stupid way to get a weighted result. But I'm stupid so it's normal.
-            suffix_length = length[random.randint(0, 5)]
+        records = [
+            "Field Day Morse Trainer log\n"
+            + field("ADIF_VER", "3.1.4")
+            + field("PROGRAMID", "FDMT")
+            + "<EOH>\n"
+        ]
+        for qso in self.qsos:
+            when = time.gmtime(qso.time)
+            records.append(
+                field("CALL", qso.logged_callsign)
+                + field("QSO_DATE", time.strftime("%Y%m%d", when))
+                + field("TIME_ON", time.strftime("%H%M%S", when))
+                + field("BAND", self.BAND)
+                + field("FREQ", f"{self.FREQUENCY / 1000:.3f}")
+                + field("MODE", "CW")
+                + field("CONTEST_ID", "ARRL-FD")
+                + field("CLASS", qso.logged_class)
+                + field("ARRL_SECT", qso.logged_section)
+                + field("STATION_CALLSIGN", settings["MY_CALLSIGN"])
+                + field("MY_ARRL_SECT", settings["MY_SECTION"])
+                + field("APP_FDMT_CALL", qso.callsign)
+                + field("APP_FDMT_CLASS", qso.klass)
+                + field("APP_FDMT_SECTION", qso.section)
+                + field("APP_FDMT_WPM", qso.speed)
+                + field("APP_FDMT_RESOLVE", f"{qso.resolve_time:.1f}")
+                + "<EOR>\n"
+            )
+        with open(path, "wt", encoding="utf-8") as file_descriptor:
+            file_descriptor.write("".join(records))
 
-        for unused_variable in range(suffix_length):
-            callsign += letters[random.randint(0, 25)]
 
-        return callsign
+class Statistics:
+    """
+    Running numbers on how the operator is copying, updated a contact at a
+    time and never recounted: QSO rate over the last 10 and 60 minutes,
+    accuracy per character sent with what it was mistaken for, and how
+    often a contact had an error, by caller speed.
+    """
+
+    WINDOWS = (10, 60)
+    SPEED_STEP = 5
+
+    def __init__(self):
+        self.windows = {minutes: deque() for minutes in self.WINDOWS}
+        self.qsos = 0
+        self.errored = 0
+        self.sent = {}
+        self.missed = {}
+        self.confusion = {}
+        self.speeds = {}
 
     @staticmethod
-    def generate_section(call):
-        """Generate section based on call region"""
-        call_areas = {
-            "0": "CO MO IA ND KS NE MN SD",
-            "1": "CT RI EMA VT ME WMA NH",
-            "2": "ENY NNY NLI SNJ NNJ WNY",
-            "3": "DE MDC EPA WPA",
-            "4": "AL SC GA SFL KY TN NC VA NFL VI PR WCF",
-            "5": "AR NTX LA OK MS STX NM WTX",
-            "6": "EBA SCV LAX SDG ORG SF PAC SJV SB SV",
-            "7": "AK NV AZ OR EWA UT ID WWA MT WY",
-            "8": "MI WV OH",
-            "9": "IL WI IN",
-        }
-        if call[1].isdigit():
-            area = call[1]
-        else:
-            area = call[2]
-        sections = call_areas[area].split()
-        return sections[random.randint(0, len(sections) - 1)]
-
-    def levenshtein(self, str1, str2):
-        """This must be magic, This code block is all over github so it works then right?!?"""
-        if len(str1) < len(str2):
-            return self.levenshtein(str2, str1)
-
-        if len(str2) == 0:
-            return len(str1)
-
-        previous_row = range(len(str2) + 1)
-        for i, character1 in enumerate(str1):
-            current_row = [i + 1]
-            for j, character2 in enumerate(str2):
-                insertions = (
-                    previous_row[j + 1] + 1
-                )  # j+1 instead of j since previous_row and current_row are one character longer
-                deletions = current_row[j] + 1  # than s2
-                substitutions = previous_row[j] + (character1 != character2)
-                current_row.append(min(insertions, deletions, substitutions))
-            previous_row = current_row
-
-        return previous_row[-1]
-
-    def run_ltest(self, str1, str2):
-        """Does it work?"""
-        ltest = self.levenshtein(str1, str2)
-        return float(ltest) / float(len(str1))
+    def align(sent: str, copied: str) -> list:
+        """
+        Pair each character sent with what was copied for it, "" where one
+        was dropped or added, by the fewest edits. Fields are short, so this
+        is a handful of operations.
+        """
+        rows, columns = len(sent) + 1, len(copied) + 1
+        cost = [[0] * columns for _ in range(rows)]
+        for i in range(rows):
+            cost[i][0] = i
+        for j in range(columns):
+            cost[0][j] = j
+        for i in range(1, rows):
+            for j in range(1, columns):
+                cost[i][j] = min(
+                    cost[i - 1][j - 1] + (sent[i - 1] != copied[j - 1]),
+                    cost[i - 1][j] + 1,
+                    cost[i][j - 1] + 1,
+                )
+        pairs = []
+        i, j = len(sent), len(copied)
+        while i or j:
+            if (
+                i
+                and j
+                and cost[i][j] == cost[i - 1][j - 1] + (sent[i - 1] != copied[j - 1])
+            ):
+                pairs.append((sent[i - 1], copied[j - 1]))
+                i, j = i - 1, j - 1
+            elif i and cost[i][j] == cost[i - 1][j] + 1:
+                pairs.append((sent[i - 1], ""))
+                i -= 1
+            else:
+                pairs.append(("", copied[j - 1]))
+                j -= 1
+        pairs.reverse()
+        return pairs
+
+    def add(self, qso: QSO) -> None:
+        """Count one contact."""
+        for minutes, window in self.windows.items():
+            window.append(qso.time)
+            self.expire(window, minutes, qso.time)
+        self.qsos += 1
+        fields = (
+            (qso.callsign, qso.logged_callsign),
+            (qso.klass, qso.logged_class),
+            (qso.section, qso.logged_section),
+        )
+        wrong = False
+        for sent, copied in fields:
+            if sent == copied:
+                for character in sent:
+                    self.sent[character] = self.sent.get(character, 0) + 1
+                continue
+            wrong = True
+            for sent_character, copied_character in self.align(sent, copied):
+                if sent_character:
+                    self.sent[sent_character] = self.sent.get(sent_character, 0) + 1
+                if sent_character != copied_character:
+                    key = sent_character or copied_character
+                    self.missed[key] = self.missed.get(key, 0) + 1
+                    pair = (sent_character, copied_character)
+                    self.confusion[pair] = self.confusion.get(pair, 0) + 1
+        self.errored += wrong
+        speed = qso.speed // self.SPEED_STEP * self.SPEED_STEP
+        counts = self.speeds.setdefault(speed, [0, 0])
+        counts[0] += 1
+        counts[1] += wrong
 
     @staticmethod
-    def log(line: str) -> None:
-        """This is here because I'm too lazy to convert all the 'f' strings to %s crap."""
-        logging.info(line)
+    def expire(window: deque, minutes: int, now: float) -> None:
+        """Drop contacts older than the window."""
+        while window and window[0] <= now - minutes * 60:
+            window.popleft()
+
+    def rate(self, minutes: int, now: float = None) -> int:
+        """QSOs an hour over the last minutes."""
+        window = self.windows[minutes]
+        self.expire(window, minutes, time.time() if now is None else now)
+        return len(window) * 60 // minutes
+
+    def accuracy(self) -> float:
+        """Share of characters sent that were copied right."""
+        sent = sum(self.sent.values())
+        return 1.0 - sum(self.missed.values()) / sent if sent else 1.0
+
+    def worst(self, count: int = 5) -> list:
+        """
+        The characters most often copied wrong, as (character, times wrong,
+        times sent, what it was most often taken for).
+        """
+        worst = []
+        for character, missed in sorted(
+            self.missed.items(), key=lambda item: item[1], reverse=True
+        )[:count]:
+            mistaken = [
+                (times, copied or "nothing")
+                for (sent, copied), times in self.confusion.items()
+                if sent == character
+            ] or [(missed, "extra")]
+            worst.append(
+                (character, missed, self.sent.get(character, 0), max(mistaken)[1])
+            )
+        return worst
+
+    def report(self) -> str:
+        """A few lines for the dashboard."""
+        lines = [
+            f"Rate   10m {self.rate(10):>4}/h   60m {self.rate(60):>4}/h",
+            f"QSOs {self.qsos:>6}   busted {self.errored:>5}",
+            f"Copy {100 * self.accuracy():>6.1f}%",
+            "",
+            "Missed   wrong/sent  as",
+        ]
+        for character, missed, sent, mistaken in self.worst():
+            lines.append(f"  {character:<6} {missed:>5}/{sent:<5} {mistaken}")
+        lines += ["", "WPM     QSOs  busted"]
+        for speed in sorted(self.speeds):
+            qsos, wrong = self.speeds[speed]
+            lines.append(
+                f"{speed:>2}-{speed + self.SPEED_STEP - 1:<3} {qsos:>6} "
+                f"{100 * wrong // qsos:>6}%"
+            )
+        return "\n".join(lines)
+
+
+class DifficultyController:
+    """
+    Sets each new pileup's difficulty from how the last few contacts went.
+    Copying well and quickly brings faster callers, more of them, closer
+    together in pitch, struggling eases off, a step at a time. After a
+    change it waits for a fresh set of contacts before judging again.
+    """
+
+    WINDOW = 5
+    GOOD_ACCURACY = 0.9
+    POOR_ACCURACY = 0.6
+    QUICK_RESOLVE = 20.0
+    SLOW_RESOLVE = 45.0
+    SPEEDS = (5, 50)
+    CALLERS = (1, 12)
+    BAND_WIDTHS = (100, 1000)
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.current = self.from_settings()
+        self.recent = deque(maxlen=self.WINDOW)
+        # Wherever you start from stays in range, even outside the usual limits.
+        start = self.current
+        self.callers = self.widen(self.CALLERS, start.callers)
+        self.speeds = self.widen(self.SPEEDS, start.minimum_speed, start.maximum_speed)
+        self.band_widths = self.widen(self.BAND_WIDTHS, start.band_width)
+
+    @staticmethod
+    def from_settings(callers: int = None) -> Difficulty:
+        """The difficulty set in fdm_settings.json."""
+        return Difficulty(
+            callers if callers is not None else settings["MAX_CALLERS"],
+            settings["MINIMUM_CALLER_SPEED"],
+            settings["MAXIMUM_CALLER_SPEED"],
+            settings["BAND_WIDTH"],
+        )
+
+    @staticmethod
+    def widen(limits: tuple, *values) -> tuple:
+        """limits stretched to take in values."""
+        return min(limits[0], *values), max(limits[1], *values)
+
+    @staticmethod
+    def nudge(value: int, change: int, limits: tuple) -> int:
+        """
+        value moved by change, kept within limits, but never pushed the
+        other way by them.
+        """
+        moved = max(limits[0], min(limits[1], value + change))
+        return max(value, moved) if change > 0 else min(value, moved)
+
+    def add(self, qso: QSO) -> bool:
+        """Judge one more contact, returns True if the difficulty changed."""
+        if not self.enabled:
+            return False
+        correct = (qso.logged_callsign, qso.logged_class, qso.logged_section) == (
+            qso.callsign,
+            qso.klass,
+            qso.section,
+        )
+        self.recent.append((correct, qso.resolve_time))
+        if len(self.recent) < self.WINDOW:
+            return False
+        accuracy = sum(correct for correct, _ in self.recent) / len(self.recent)
+        resolve_time = sum(seconds for _, seconds in self.recent) / len(self.recent)
+        if accuracy >= self.GOOD_ACCURACY and resolve_time <= self.QUICK_RESOLVE:
+            self.step(1)
+            return True
+        if accuracy < self.POOR_ACCURACY or resolve_time > self.SLOW_RESOLVE:
+            self.step(-1)
+            return True
+        return False
+
+    def step(self, direction: int) -> None:
+        """One notch harder, or easier if direction is negative."""
+        difficulty = self.current
+        minimum_speed = self.nudge(difficulty.minimum_speed, 2 * direction, self.speeds)
+        self.current = Difficulty(
+            self.nudge(difficulty.callers, direction, self.callers),
+            minimum_speed,
+            max(
+                self.nudge(difficulty.maximum_speed, 2 * direction, self.speeds),
+                minimum_speed,
+            ),
+            self.nudge(difficulty.band_width, -100 * direction, self.band_widths),
+        )
+        self.recent.clear()
+
+    def describe(self) -> str:
+        """The current difficulty for the status bar."""
+        difficulty = self.current
+        return (
+            f"{difficulty.callers} callers, {difficulty.minimum_speed}-"
+            f"{difficulty.maximum_speed} WPM, {difficulty.band_width} Hz"
+        )
+
+
+class Transmitter(QtCore.QThread):
+    """
+    Sends the operators messages through the session and follows them from a
+    worker thread, so the window never waits on the audio. Messages queue up
+    and go out one after another. Once a message has been sent, what the
+    callers are meant to make of it is posted to the pileup.
+    """
+
+    sending = QtCore.pyqtSignal(str)
+    progress = QtCore.pyqtSignal(int)
+    sent = QtCore.pyqtSignal(str, object)
+
+    def __init__(self, session: Session, parent=None):
+        super().__init__(parent)
+        self.session = session
+        self.queue = queue.Queue()
+        self.keyed = False  # set while handling a message sent on the key
+        session.on_send = self.watch
+
+    def send(self, morse_output: str, kind: EventKind = None, guess: str = "") -> None:
+        """Queue a message, the event is posted to the callers once it's been sent."""
+        self.session.send(morse_output, kind, guess, self.keyed)
+
+    def watch(self, morse_output: str, kind: EventKind, voice: Voice) -> None:
+        """The session has started keying a message, called from the audio thread."""
+        self.queue.put((morse_output, kind, voice))
+
+    def run(self):
+        """Worker loop, one message at a time."""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            morse_output, kind, voice = item
+            self.sending.emit(morse_output)
+            while not voice.wait(0.1):
+                self.progress.emit(100 * voice.position // max(1, len(voice.samples)))
+            self.progress.emit(100)
+            self.sent.emit(morse_output, kind)
+
+    def stop(self) -> None:
+        """Drop anything still queued and stop the worker."""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put(None)
+        self.wait(1000)
+
+
+class QSOTableModel(QtCore.QAbstractTableModel):
+    """
+    The contest log for the log pane, newest contact first. Rows are read
+    straight from the ContestLog, nothing is built per row, and older rows
+    are only handed to the view as it scrolls down to them, a batch at a
+    time. A new contact is one row inserted at the top.
+    """
+
+    COLUMNS = ("UTC", "Call", "Class", "Sect", "WPM", "Errors")
+    BATCH = 200
+    WRONG = QtGui.QColor(239, 41, 41)
+
+    def __init__(self, contest_log: ContestLog, parent=None):
+        super().__init__(parent)
+        self.contest_log = contest_log
+        self.loaded = min(len(contest_log.qsos), self.BATCH)
+
+    def qso(self, row: int) -> QSO:
+        """The contact shown on row."""
+        return self.contest_log.qsos[len(self.contest_log.qsos) - 1 - row]
+
+    def rowCount(self, parent=QtCore.QModelIndex()) -> int:
+        """How many rows the view has been given so far."""
+        return 0 if parent.isValid() else self.loaded
+
+    def columnCount(self, parent=QtCore.QModelIndex()) -> int:
+        """One column per field."""
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()) -> bool:
+        """Are there older contacts the view hasn't been given."""
+        return not parent.isValid() and self.loaded < len(self.contest_log.qsos)
+
+    def fetchMore(self, parent=QtCore.QModelIndex()) -> None:
+        """Hand the view the next batch of older contacts."""
+        if parent.isValid():
+            return
+        count = min(self.BATCH, len(self.contest_log.qsos) - self.loaded)
+        if count <= 0:
+            return
+        self.beginInsertRows(parent, self.loaded, self.loaded + count - 1)
+        self.loaded += count
+        self.endInsertRows()
+
+    def add(self, qso: QSO) -> None:
+        """Log a contact and show it at the top."""
+        self.beginInsertRows(QtCore.QModelIndex(), 0, 0)
+        self.contest_log.add(qso)
+        self.loaded += 1
+        self.endInsertRows()
+
+    def headerData(self, section: int, orientation, role=Qt.DisplayRole):
+        """Column titles."""
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.COLUMNS[section]
+        return None
+
+    @staticmethod
+    def errors(qso: QSO) -> int:
+        """How many of call, class and section were copied wrong."""
+        return (
+            (qso.logged_callsign != qso.callsign)
+            + (qso.logged_class != qso.klass)
+            + (qso.logged_section != qso.section)
+        )
+
+    def data(self, index: QtCore.QModelIndex, role=Qt.DisplayRole):
+        """A cell, a copied field that's wrong is red with what was sent beside it."""
+        if not index.isValid():
+            return None
+        qso = self.qso(index.row())
+        column = index.column()
+        if 1 <= column <= 3:
+            logged, sent = (
+                (qso.logged_callsign, qso.callsign),
+                (qso.logged_class, qso.klass),
+                (qso.logged_section, qso.section),
+            )[column - 1]
+            if role == Qt.DisplayRole:
+                return logged if logged == sent else f"{logged} ({sent})"
+            if role == Qt.ForegroundRole and logged != sent:
+                return self.WRONG
+            if role == Qt.ToolTipRole and logged != sent:
+                return f"Sent {sent}"
+            return None
+        if role == Qt.DisplayRole:
+            if column == 0:
+                return time.strftime("%H:%M:%S", time.gmtime(qso.time))
+            if column == 4:
+                return qso.speed
+            return self.errors(qso) or ""
+        if role == Qt.ForegroundRole and column == 5 and self.errors(qso):
+            return self.WRONG
+        return None
+
+
+class StatsPanel(QtWidgets.QDockWidget):
+    """The dashboard down the side of the window, redrawn after every contact."""
+
+    def __init__(self, statistics: Statistics, parent=None):
+        super().__init__("Stats", parent)
+        self.statistics = statistics
+        self.label = QtWidgets.QLabel()
+        self.label.setFont(
+            QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont)
+        )
+        self.label.setAlignment(Qt.AlignTop | Qt.AlignLeft)
+        self.label.setMargin(6)
+        self.setWidget(self.label)
+        self.setFeatures(QtWidgets.QDockWidget.DockWidgetClosable)
+        self.setFocusPolicy(Qt.NoFocus)
+        # The rates fall off with time even if nothing is logged.
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(30000)
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Show the latest numbers."""
+        self.label.setText(self.statistics.report())
+
+
+class LatencyPanel(QtWidgets.QPlainTextEdit):
+    """A window showing the latency histograms, refreshed every second."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Latency, microseconds")
+        self.setReadOnly(True)
+        self.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        self.resize(560, 200)
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(1000)
+
+    def refresh(self) -> None:
+        """Show the latest numbers."""
+        self.setPlainText(instruments.table())
 
 
 class MainWindow(QtWidgets.QMainWindow):
     """Main Window"""
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, seed: int = None):
         """init the class"""
         super().__init__(parent)
         uic.loadUi(self.relpath("contest.ui"), self)
         self.participants = None
+        self.mixer = Mixer(period=settings["AUDIO_PERIOD"])
+        self.session = Session(self.mixer, seed)
+        self.pileup = self.session.pileup
+        self.transmitter = Transmitter(self.session, self)
+        self.transmitter.sending.connect(self.transmission_started)
+        self.transmitter.progress.connect(self.transmission_progress)
+        self.transmitter.sent.connect(self.transmission_sent)
+        self.transmitter.start()
+        self.audio = AudioOutput(self.session)
+        self.send_progressBar = QtWidgets.QProgressBar()
+        self.send_progressBar.setMaximumWidth(150)
+        self.send_progressBar.setRange(0, 100)
+        self.statusbar.addPermanentWidget(self.send_progressBar)
+        self.filter_width = settings["RECEIVER_FILTER"]
+        self.filter_label = QtWidgets.QLabel(f"{self.filter_width} Hz")
+        self.statusbar.addPermanentWidget(self.filter_label)
+        self.logging = []
+        self.contest_log = ContestLog(settings["LOG_JOURNAL"])
+        self.log_model = QSOTableModel(self.contest_log, self)
+        self.log_tableView.setModel(self.log_model)
+        self.log_tableView.horizontalHeader().setSectionResizeMode(
+            QtWidgets.QHeaderView.Stretch
+        )
+        self.log_tableView.verticalHeader().setDefaultSectionSize(20)
+        self.statistics = Statistics()
+        for qso in self.contest_log.qsos:
+            self.statistics.add(qso)
+        self.stats_panel = StatsPanel(self.statistics, self)
+        self.difficulty = DifficultyController(settings["ADAPTIVE_DIFFICULTY"])
+        self.partial_index = PartialIndex(self.pileup.callsigns.database)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.stats_panel)
+        self.guessed_callsign = ""
+        self.guessed_class = ""
+        self.guessed_section = ""
         self.spawn()
         self.cq_pushButton.clicked.connect(self.send_cq)
         self.report_pushButton.clicked.connect(self.send_report)
@@ -491,31 +3533,55 @@ class MainWindow(QtWidgets.QMainWindow):
         self.agn_section_pushButton.clicked.connect(self.send_repeat_section)
         self.callsign_lineEdit.textChanged.connect(self.call_changed)
         self.callsign_lineEdit.textEdited.connect(self.call_test)
+        self.callsign_lineEdit.textEdited.connect(self.call_lookup)
         self.class_lineEdit.textEdited.connect(self.class_test)
         self.class_lineEdit.returnPressed.connect(self.send_confirm)
         self.section_lineEdit.textEdited.connect(self.section_test)
         self.section_lineEdit.returnPressed.connect(self.send_confirm)
-        self.timetosend = CalculatePhraseTime()
-        self.side_tone = f"-f {settings['SIDE_TONE']}"
-        self.wpm = f"-w {settings['MY_SPEED']}"
-        self.vol = "-v 0.3"
         self.resend_timer = QtCore.QTimer()
         self.resend_timer.timeout.connect(self.reinsert_cq_message)
+        self.keying = False
+        self.paddles = [False, False]
+        self.decoder = CWDecoder(self.mixer.sample_rate, settings["MY_SPEED"])
+        self.keyed_text = ""
+        self.key_input = KeyInput(
+            self.session, settings["KEYER_SERIAL"], settings["KEYER_MIDI"]
+        )
+        self.decode_timer = QtCore.QTimer()
+        self.decode_timer.timeout.connect(self.decode)
+        self.decode_timer.start(10)
+        QtWidgets.QApplication.instance().installEventFilter(self)
+        self.latency_panel = None
+        if Path("./debug").exists():
+            self.latency_panel = LatencyPanel()
+            self.latency_panel.show()
 
     def spawn(self):
         """spin up the people"""
-        threadCount = QThreadPool.globalInstance().maxThreadCount()
-        if threadCount > settings["MAX_CALLERS"]:
-            threadCount = settings["MAX_CALLERS"]
-        pool = QThreadPool.globalInstance()
-        for i in range(threadCount):
-            ham = Ham(i)
-            pool.start(ham)
+        self.session.spawn(self.difficulty.current)
 
     def call_changed(self):
         """Callsign text field to uppercase"""
-        global guessed_callsign
-        guessed_callsign = self.callsign_lineEdit.text().upper()
+        self.guessed_callsign = self.callsign_lineEdit.text().upper()
+        if not self.guessed_callsign:
+            self.scp_label.setText("")
+            self.callsign_lineEdit.setStyleSheet("")
+
+    def call_lookup(self):
+        """Show worked and known calls matching what's typed, flag a dupe."""
+        started = time.perf_counter()
+        callsign = self.callsign_lineEdit.text().upper()
+        worked, known = self.partial_index.lookup(callsign, 8)
+        instruments.record("partial lookup", time.perf_counter() - started)
+        if self.partial_index.is_dupe(callsign):
+            self.scp_label.setText(f"DUPE {callsign}")
+            self.scp_label.setStyleSheet("color: rgb(239, 41, 41);")
+            self.callsign_lineEdit.setStyleSheet("color: rgb(239, 41, 41);")
+            return
+        self.callsign_lineEdit.setStyleSheet("")
+        self.scp_label.setStyleSheet("")
+        matches = worked + [call for call in known if call not in worked]
+        self.scp_label.setText(" ".join(matches[:8]))
 
     def call_test(self):
         """
@@ -529,7 +3595,9 @@ class MainWindow(QtWidgets.QMainWindow):
                 self.class_lineEdit.deselect()
             else:
                 washere = self.callsign_lineEdit.cursorPosition()
-                cleaned = "".join(ch for ch in text if ch.isalnum()).upper()
+                cleaned = "".join(
+                    ch for ch in text if ch.isascii() and ch.isalnum()
+                ).upper()
                 self.callsign_lineEdit.setText(cleaned)
                 self.callsign_lineEdit.setCursorPosition(washere)
 
@@ -537,7 +3605,6 @@ class MainWindow(QtWidgets.QMainWindow):
         """
         Test and strip class of bad characters, advance to next input field if space pressed.
         """
-        global guessed_class
         text = self.class_lineEdit.text()
         if len(text):
             if text[-1] == " ":
@@ -547,7 +3614,7 @@ class MainWindow(QtWidgets.QMainWindow):
             else:
                 washere = self.class_lineEdit.cursorPosition()
                 cleaned = "".join(ch for ch in text if ch.isalnum()).upper()
-                guessed_class = cleaned
+                self.guessed_class = cleaned
                 self.class_lineEdit.setText(cleaned)
                 self.class_lineEdit.setCursorPosition(washere)
 
@@ -555,7 +3622,6 @@ class MainWindow(QtWidgets.QMainWindow):
         """
         Test and strip class of bad characters, advance to next input field if space pressed.
         """
-        global guessed_section
         text = self.section_lineEdit.text()
         if len(text):
             if text[-1] == " ":
@@ -565,187 +3631,228 @@ class MainWindow(QtWidgets.QMainWindow):
             else:
                 washere = self.section_lineEdit.cursorPosition()
                 cleaned = "".join(ch for ch in text if ch.isalnum()).upper()
-                guessed_section = cleaned
+                self.guessed_section = cleaned
                 self.section_lineEdit.setText(cleaned)
                 self.section_lineEdit.setCursorPosition(washere)
 
     def reinsert_cq_message(self):
         """if no activity from OP callers resend calls"""
-        global message
-        message = f"CQ {time.clock_gettime(1)}"
+        self.session.post(EventKind.CQ)
         self.resend_timer.start(10000)
 
     def send_cq(self):
         """Send CQ FD"""
         self.resend_timer.stop()
-        global message, result
-        result = []
+        self.session.clear()
         morse_output = f"CQ FD DE {settings['MY_CALLSIGN']}"
-        time_to_send = self.timetosend.time_for_phrase(
-            settings["MY_SPEED"], morse_output
-        )
-        try:
-            subprocess.run(
-                ["morse", self.side_tone, self.wpm, self.vol, morse_output],
-                timeout=time_to_send,
-                check=False,
-            )
-        except subprocess.TimeoutExpired:
-            self.log(f"Morse Timeout: '{morse_output}' [{time_to_send}]")
-        message = f"CQ {time.clock_gettime(1)}"
-        self.resend_timer.start(10000)
+        self.transmitter.send(morse_output, EventKind.CQ)
 
     def send_report(self):
         """Answer callers with their callsign"""
         self.resend_timer.stop()
-        global message, guessed_callsign
         guessed_callsign = self.callsign_lineEdit.text()
         self.callsign_lineEdit.setText(guessed_callsign.upper())
+        if self.partial_index.is_dupe(guessed_callsign.upper()):
+            self.statusbar.showMessage(f"{guessed_callsign.upper()} is a dupe", 3000)
         morse_output = (
             f"{guessed_callsign} {settings['MY_CLASS']} {settings['MY_SECTION']}"
         )
-        time_to_send = self.timetosend.time_for_phrase(
-            settings["MY_SPEED"], morse_output
+        self.transmitter.send(
+            morse_output, EventKind.RESPONSE, guessed_callsign.upper()
         )
-        try:
-            subprocess.run(
-                ["morse", self.side_tone, self.wpm, self.vol, morse_output],
-                timeout=time_to_send,
-                check=False,
-            )
-        except subprocess.TimeoutExpired:
-            self.log(f"Morse Timeout: '{morse_output}' [{time_to_send}]")
-        message = f"RESPONSE {time.clock_gettime(1)}"
 
     def send_repeat_call(self):
         """Ask caller for his/her/non-binary call again"""
         self.resend_timer.stop()
-        global message
         morse_output = f"{self.callsign_lineEdit.text()}"
-        time_to_send = self.timetosend.time_for_phrase(
-            settings["MY_SPEED"], morse_output
-        )
-        try:
-            subprocess.run(
-                ["morse", self.side_tone, self.wpm, self.vol, morse_output],
-                timeout=time_to_send,
-                check=False,
-            )
-        except subprocess.TimeoutExpired:
-            self.log(f"Morse Timeout: '{morse_output}' [{time_to_send}]")
-        message = f"PARTIAL {time.clock_gettime(1)}"
+        self.transmitter.send(morse_output, EventKind.PARTIAL, morse_output.upper())
 
     def send_repeat_class(self):
         """Ask caller for class again"""
         self.resend_timer.stop()
-        global message
         morse_output = "cls?"
-        time_to_send = self.timetosend.time_for_phrase(
-            settings["MY_SPEED"], morse_output
+        self.transmitter.send(
+            morse_output, EventKind.RESENDCLASS, self.guessed_callsign
         )
-        try:
-            subprocess.run(
-                ["morse", self.side_tone, self.wpm, self.vol, morse_output],
-                timeout=time_to_send,
-                check=False,
-            )
-        except subprocess.TimeoutExpired:
-            self.log(f"Morse Timeout: '{morse_output}' [{time_to_send}]")
-        message = f"RESENDCLASS {time.clock_gettime(1)}"
 
     def send_repeat_section(self):
         """Ask caller for section"""
         self.resend_timer.stop()
-        global message
         morse_output = "sec?"
-        time_to_send = self.timetosend.time_for_phrase(
-            settings["MY_SPEED"], morse_output
+        self.transmitter.send(
+            morse_output, EventKind.RESENDSECTION, self.guessed_callsign
         )
-        try:
-            subprocess.run(
-                ["morse", self.side_tone, self.wpm, self.vol, morse_output],
-                timeout=time_to_send,
-                check=False,
-            )
-        except subprocess.TimeoutExpired:
-            self.log(f"Morse Timeout: '{morse_output}' [{time_to_send}]")
-        message = f"RESENDSECTION {time.clock_gettime(1)}"
 
     def send_confirm(self):
-        """Send equivilent of TU QRZ"""
+        """
+        Send equivilent of TU QRZ. The entry fields are cleared right away so the
+        next call can be typed, the contact is logged once the tu has gone out.
+        """
         self.resend_timer.stop()
-        global result
         if (
             self.section_lineEdit.text() == ""
             or self.class_lineEdit.text() == ""
             or self.callsign_lineEdit.text() == ""
         ):
             return
-        self.resend_timer.stop()
-        global message, guessed_callsign, guessed_class, guessed_section, call_resolved
-        message = f"QRZ {time.clock_gettime(1)}"
-        morse_output = f"tu {settings['MY_CALLSIGN']} fd"
-        time_to_send = self.timetosend.time_for_phrase(
-            settings["MY_SPEED"], morse_output
+        self.session.post(EventKind.QRZ)
+        self.logging.append(
+            [self.guessed_callsign, self.guessed_class, self.guessed_section]
         )
-        try:
-            subprocess.run(
-                ["morse", self.side_tone, self.wpm, self.vol, morse_output],
-                timeout=time_to_send,
-                check=False,
-            )
-        except subprocess.TimeoutExpired:
-            self.log(f"Morse Timeout: '{morse_output}' [{time_to_send}]")
-
-        self.check_result()
-        result = ["", "", ""]
-        message = "DIE "
-        time.sleep(1)
+        morse_output = f"tu {settings['MY_CALLSIGN']} fd"
+        self.transmitter.send(morse_output, EventKind.TU)
 
         self.section_lineEdit.setText("")
         self.class_lineEdit.setText("")
         self.callsign_lineEdit.setText("")
         self.callsign_lineEdit.setFocus()
-        call_resolved = False
-        message = ""
-        guessed_callsign = ""
-        guessed_class = ""
-        guessed_section = ""
-        self.spawn()
-        self.reinsert_cq_message()
+        self.guessed_callsign = ""
+        self.guessed_class = ""
+        self.guessed_section = ""
 
     def send_nil(self):
         """Send not in log"""
-        global message
-        message = "DIE "
-        time.sleep(1)
+        self.session.post(EventKind.TU)
+        self.session.clear()
         self.spawn()
 
-    def check_result(self):
-        """See if you were right."""
-        global result
-        if not result:
-            result = ["", "", ""]
-        if guessed_callsign == result[0]:
-            a = guessed_callsign
-        else:
-            a = f"{guessed_callsign} ({result[0]})"
-        if guessed_class == result[1]:
-            b = guessed_class
+    def toggle_adaptive(self):
+        """Let the trainer set the difficulty, or go back to the settings."""
+        self.difficulty = DifficultyController(not self.difficulty.enabled)
+        if self.difficulty.enabled:
+            self.statusbar.showMessage(
+                f"Adaptive difficulty on: {self.difficulty.describe()}", 3000
+            )
         else:
-            b = f"{guessed_class} ({result[1]})"
-        if guessed_section == result[2]:
-            c = guessed_section
+            self.statusbar.showMessage("Adaptive difficulty off", 3000)
+
+    def narrow_filter(self):
+        """Step the receiver filter down to the next width, round to the widest."""
+        widths = sorted(set(settings["FILTER_WIDTHS"]) | {self.filter_width})
+        narrower = [width for width in widths if width < self.filter_width]
+        self.filter_width = narrower[-1] if narrower else widths[-1]
+        self.session.filter(self.filter_width)
+        self.filter_label.setText(f"{self.filter_width} Hz")
+
+    def toggle_keying(self):
+        """Switch the [ and ] keys between typing and keying."""
+        self.keying = not self.keying
+        if self.keying:
+            self.statusbar.showMessage("Keying on: [ dit, ] dah", 3000)
         else:
-            c = f"{guessed_section} ({result[2]})"
+            self.statusbar.showMessage("Keying off", 3000)
 
-        logline = f"{a} \t{b} \t{c}"
-        self.log_listWidget.addItem(logline)
-        self.log_listWidget.scrollToBottom()
+    def eventFilter(self, obj, event) -> bool:  # pylint: disable=invalid-name
+        """While keying, [ and ] are the paddles, wherever the focus is."""
+        if (
+            self.keying
+            and event.type() in (QtCore.QEvent.KeyPress, QtCore.QEvent.KeyRelease)
+            and event.key() in (Qt.Key_BracketLeft, Qt.Key_BracketRight)
+        ):
+            if not event.isAutoRepeat():
+                down = event.type() == QtCore.QEvent.KeyPress
+                if settings["KEYER_MODE"] == "straight":
+                    self.session.key(down)
+                elif event.key() == Qt.Key_BracketLeft:
+                    self.paddles[0] = down
+                    self.session.paddles(*self.paddles)
+                else:
+                    self.paddles[1] = down
+                    self.session.paddles(*self.paddles)
+            return True
+        return super().eventFilter(obj, event)
+
+    def decode(self):
+        """Copy what's been keyed, and act on it once you stop sending."""
+        transitions = self.mixer.keyer.transitions
+        text = ""
+        while transitions:
+            text += self.decoder.feed(*transitions.popleft())
+        now = self.mixer.ring.written
+        text += self.decoder.idle(now)
+        if text:
+            self.keyed_text += text
+            self.statusbar.showMessage(f"Keyed: {self.keyed_text}")
+        message = self.decoder.message(now)
+        if message:
+            self.keyed_text = ""
+            self.keyed_message(message)
+
+    def keyed_message(self, text: str) -> None:
+        """
+        Do what a message sent on the key asks, through the same handlers as
+        the function keys. It's already gone out, so nothing more is sent.
+        """
+        self.log(f"Keyed: {text}")
+        words = text.split()
+        self.transmitter.keyed = True
+        try:
+            if words[0] == "CQ":
+                self.send_cq()
+            elif "TU" in words:
+                self.send_confirm()
+            elif words[0] in ("CL?", "CLS?", "CLASS?"):
+                self.send_repeat_class()
+            elif words[0] in ("SEC?", "SECT?"):
+                self.send_repeat_section()
+            elif words[0] in ("?", "QRZ?", "AGN", "AGN?"):
+                self.transmitter.send(text, EventKind.PARTIAL, "?")
+            else:
+                self.callsign_lineEdit.setText(words[0])
+                if len(words) > 1:
+                    self.send_report()
+                else:
+                    self.send_repeat_call()
+        finally:
+            self.transmitter.keyed = False
+
+    def transmission_started(self, morse_output: str) -> None:
+        """The transmitter has started sending something."""
+        self.statusbar.showMessage(f"Sending: {morse_output}")
+        self.send_progressBar.setValue(0)
+
+    def transmission_progress(self, percent: int) -> None:
+        """How far through the current message the transmitter is."""
+        self.send_progressBar.setValue(percent)
+
+    def transmission_sent(self, morse_output: str, kind: EventKind) -> None:
+        """The transmitter finished a message, and it's been passed to the callers."""
+        self.statusbar.clearMessage()
+        self.log(f"Sent: {morse_output}")
+        if kind is EventKind.CQ:
+            self.resend_timer.start(10000)
+        if kind is EventKind.TU and self.logging:
+            self.check_result(*self.logging.pop(0))
+            self.session.clear()
+            self.spawn()
+            self.reinsert_cq_message()
+
+    def check_result(self, callsign: str, klass: str, section: str) -> None:
+        """See if what you logged is what they sent."""
+        state = self.pileup.state
+        result = state.result()
+        self.session.qso([callsign, klass, section], list(result))
+        qso = QSO(
+            round(time.time()),
+            *result,
+            callsign,
+            klass,
+            section,
+            state.speed,
+            round(state.resolve_time, 1),
+        )
+        self.log_model.add(qso)
+        self.log_tableView.scrollToTop()
+        self.partial_index.add_worked(callsign)
+        self.statistics.add(qso)
+        self.stats_panel.refresh()
+        if self.difficulty.add(qso):
+            self.statusbar.showMessage(
+                f"Next pileup: {self.difficulty.describe()}", 5000
+            )
 
     def keyPressEvent(self, event):  # pylint: disable=invalid-name
         """This extends QT's KeyPressEvent, handle tab, esc and function keys"""
-        global message
         event_key = event.key()
         self.log(event_key)
         if event_key == Qt.Key_Escape:
@@ -788,18 +3895,39 @@ class MainWindow(QtWidgets.QMainWindow):
         if event_key == Qt.Key_F6:
             self.send_repeat_section()
             return
+        if event_key == Qt.Key_F7:
+            self.toggle_adaptive()
+            return
+        if event_key == Qt.Key_F8:
+            self.narrow_filter()
+            return
         if event_key == Qt.Key_F9:
             self.send_nil()
             return
+        if event_key == Qt.Key_F10:
+            self.toggle_keying()
+            return
         if event_key == Qt.Key_F12:
-            message = "DIE "  # kill off the hams
+            self.session.post(EventKind.DIE)  # kill off the hams
             return
 
     def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
         """When app is closing send a message to Ham Zombies to signal them to die."""
-        global message
-        message = "DIE "
-        time.sleep(1)
+        self.key_input.close()
+        # Closing the audio releases any message still going out, so the
+        # transmitter isn't left waiting on it.
+        self.audio.close()
+        self.transmitter.stop()
+        self.pileup.stop()
+        self.contest_log.close()
+        if settings["SESSION_LOG"]:
+            try:
+                self.session.save(settings["SESSION_LOG"])
+            except IOError as exception:
+                logging.warning("Saving session: %s", exception)
+        if self.latency_panel is not None:
+            self.latency_panel.close()
+            instruments.dump("latency.json")
         return super().closeEvent(a0)
 
     @staticmethod
@@ -822,6 +3950,70 @@ class MainWindow(QtWidgets.QMainWindow):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Field Day Morse Trainer")
+    parser.add_argument(
+        "--import-calls",
+        nargs="+",
+        metavar="FILE",
+        help="build the callsign database from super check partial files "
+        "or Field Day Cabrillo logs, then exit",
+    )
+    parser.add_argument(
+        "--export-cabrillo",
+        metavar="FILE",
+        help="write the contest log out as Cabrillo, then exit",
+    )
+    parser.add_argument(
+        "--export-adif",
+        metavar="FILE",
+        help="write the contest log out as ADIF, then exit",
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="run a session with a pretend operator and no window",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="time headless sessions over a range of pileup sizes",
+    )
+    parser.add_argument(
+        "--callers",
+        nargs="+",
+        type=int,
+        metavar="N",
+        help="pileup size for --headless, or sizes for --benchmark",
+    )
+    parser.add_argument(
+        "--minutes",
+        type=float,
+        default=2,
+        help="simulated minutes per headless session, default 2",
+    )
+    parser.add_argument(
+        "--render",
+        metavar="FILE",
+        help="write a headless session to FILE, .wav or .opus, "
+        "with a .json timeline beside it",
+    )
+    parser.add_argument("--seed", type=int, help="seed for the session, to repeat one")
+    parser.add_argument(
+        "--replay",
+        metavar="FILE",
+        help="play a saved session log again, as fast as possible unless "
+        "--realtime, and check it came out the same",
+    )
+    parser.add_argument(
+        "--play", metavar="FILE", help="play back a rendered session, then exit"
+    )
+    parser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="run the headless session at normal speed",
+    )
+    arguments = parser.parse_args()
+
     if Path("./debug").exists():
         logging.basicConfig(level=logging.INFO)
     else:
@@ -830,18 +4022,101 @@ if __name__ == "__main__":
     try:
         if os.path.exists("./fdm_settings.json"):
             with open("./fdm_settings.json", "rt", encoding="utf-8") as file_descriptor:
-                settings = loads(file_descriptor.read())
+                settings.update(loads(file_descriptor.read()))
         else:
             with open("./fdm_settings.json", "wt", encoding="utf-8") as file_descriptor:
                 file_descriptor.write(dumps(settings, indent=4))
                 logging.info("writing: %s", settings)
     except IOError as exception:
         logging.critical("Reading Preferences: %s", exception)
+
+    if arguments.import_calls:
+        database_path = settings["CALLSIGN_DATABASE"] or "callsigns.idx"
+        imported = CallsignIndex.build(arguments.import_calls, database_path)
+        print(f"{imported} callsigns written to {database_path}")
+        if not settings["CALLSIGN_DATABASE"]:
+            print(f'Set "CALLSIGN_DATABASE": "{database_path}" in fdm_settings.json')
+        sys.exit(0)
+
+    if arguments.export_cabrillo or arguments.export_adif:
+        contest_log = ContestLog(settings["LOG_JOURNAL"])
+        if arguments.export_cabrillo:
+            contest_log.cabrillo(arguments.export_cabrillo)
+        if arguments.export_adif:
+            contest_log.adif(arguments.export_adif)
+        contest_log.close()
+        print(f"{len(contest_log.qsos)} QSOs exported")
+        sys.exit(0)
+
+    if arguments.benchmark:
+        benchmark(
+            arguments.callers or (1, 2, 5, 10, 20, 50, 100, 200),
+            arguments.minutes * 60,
+        )
+        sys.exit(0)
+
+    if arguments.replay:
+        with open(arguments.replay, "rt", encoding="utf-8") as file_descriptor:
+            record = loads(file_descriptor.read())
+        simulation = Simulation.replay(record, arguments.render)
+        started = time.perf_counter()
+        simulation.run(record["samples"] / record["sample_rate"], arguments.realtime)
+        elapsed = time.perf_counter() - started
+        for _, worked, logged in simulation.qsos():
+            print(" ".join(logged), "" if logged == worked else f"({' '.join(worked)})")
+        same = (
+            simulation.session.checksum == record["checksum"]
+            and not simulation.session.mismatches
+        )
+        print(
+            f"{len(record['actions'])} actions replayed in {elapsed:.1f}s, "
+            f"{'identical' if same else 'DIFFERENT'}"
+        )
+        if Path("./debug").exists():
+            print(instruments.table())
+            instruments.dump("latency.json")
+        sys.exit(0 if same else 1)
+
+    if arguments.headless or arguments.render:
+        simulation = Simulation(
+            arguments.callers[0] if arguments.callers else settings["MAX_CALLERS"],
+            arguments.render,
+            seed=arguments.seed,
+        )
+        started = time.perf_counter()
+        simulation.run(arguments.minutes * 60, arguments.realtime)
+        elapsed = time.perf_counter() - started
+        qsos = simulation.qsos()
+        good = sum(worked == logged for _, worked, logged in qsos)
+        print(
+            f"{len(qsos)} QSOs, {good} logged correctly, in {elapsed:.1f}s, "
+            f"seed {simulation.seed}"
+        )
+        if Path("./debug").exists():
+            print(instruments.table())
+            instruments.dump("latency.json")
+        sys.exit(0)
+
+    if arguments.play:
+        try:
+            player = SessionPlayer(arguments.play, settings["AUDIO_PERIOD"])
+        except (OSError, ValueError, EOFError, wave.Error) as exception:
+            sys.exit(f"Can't play {arguments.play}: {exception}")
+        output = AudioOutput(player)
+        try:
+            player.finished.wait()
+        except KeyboardInterrupt:
+            pass
+        output.close()
+        for qso in player.timeline.get("qsos", []):
+            print(" ".join(qso["worked"]))
+        sys.exit(0)
+
     app = QtWidgets.QApplication(sys.argv)
     app.setStyle("Fusion")
     font_dir = relpath("font")
     families = load_fonts_from_dir(os.fspath(font_dir))
-    window = MainWindow()
+    window = MainWindow(seed=arguments.seed)
     window.show()
     window.callsign_lineEdit.setFocus()
     app.exec()